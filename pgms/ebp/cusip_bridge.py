@@ -0,0 +1,183 @@
+#------------------------------------------
+# Versioned bridge from issuer CUSIP6 to
+# integer firm keys (gvkey, permco, permno)
+# with the dates each link is valid
+#
+# usage: python3 cusip_bridge.py [path]
+# builds a new version from WRDS
+#------------------------------------------
+
+import os, sys, glob, json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BRIDGE_DIR = "./cusip_bridge"
+
+## layout of the stored table, bumped when the columns change
+BRIDGE_VERSION = 1
+
+## CRSP names with the historical (ncusip) and current CUSIP of each permno
+STOCKNAMES_SQL = """SELECT permno, permco, ncusip, cusip, namedt, nameenddt
+                    FROM crspq.stocknames"""
+
+## the same CCM links the merged panel uses
+LINK_SQL = """SELECT gvkey, lpermno AS permno, linkdt, linkenddt
+              FROM crspq.ccmxpf_linktable
+              WHERE linktype IN ('LU', 'LC')
+                AND linkprim in ('P', 'C')"""
+
+OPEN_END = pd.Timestamp("2099-12-31")
+
+#---------------------------
+# Integer CUSIP6
+#---------------------------
+
+## CUSIP characters, the six issuer characters are a base 40 number
+CUSIP_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ*@#"
+_DIGIT = np.full(256, -1, dtype=np.int64)
+_DIGIT[np.frombuffer(CUSIP_CHARS.encode(), np.uint8)] = np.arange(len(CUSIP_CHARS))
+_DIGIT[np.frombuffer(CUSIP_CHARS.lower().encode(), np.uint8)[10:36]] = np.arange(10, 36)
+
+## issuer code from the first six characters of a CUSIP (6, 8 or 9 long),
+## -1 when missing or not a CUSIP
+def cusip6_code(s):
+    s = pd.Series(s)
+    text = s.where(s.notna(), "").astype(str).str.lstrip().to_numpy().astype("S6")
+    chars = np.frombuffer(text.tobytes(), np.uint8).reshape(-1, 6) if len(text) else np.zeros((0, 6), np.uint8)
+    digits = _DIGIT[chars]
+    code = digits @ (len(CUSIP_CHARS)**np.arange(5, -1, -1))
+    return np.where((digits >= 0).all(axis=1), code, -1)
+
+#---------------------------
+# Build
+#---------------------------
+
+## one row per issuer, permno and gvkey link with the overlap of the CRSP
+## name dates and the CCM link dates; both ncusip and cusip of a name
+## record are bridged, so old CUSIPs still find the firm
+def build_bridge(stocknames, links):
+    names = pd.concat([stocknames.assign(cusip6=stocknames.ncusip),
+                       stocknames.assign(cusip6=stocknames.cusip)], ignore_index=True)
+    names['issuer'] = cusip6_code(names.cusip6)
+    names = names.loc[names.issuer >= 0, ['issuer', 'permno', 'permco', 'namedt', 'nameenddt']]
+
+    links = links.dropna(subset=['gvkey', 'permno']).copy()
+    links['gvkey'] = pd.to_numeric(links.gvkey)
+    out = names.merge(links, on='permno', how='left')
+    out['valid_from'] = pd.to_datetime(out.namedt)
+    out['valid_to'] = pd.to_datetime(out.nameenddt).fillna(OPEN_END)
+    linked = out.gvkey.notna()
+    out.loc[linked, 'valid_from'] = np.maximum(out.valid_from[linked], pd.to_datetime(out.linkdt[linked]))
+    out.loc[linked, 'valid_to'] = np.minimum(out.valid_to[linked],
+                                             pd.to_datetime(out.linkenddt[linked]).fillna(OPEN_END))
+    out = out.loc[out.valid_from <= out.valid_to, ['issuer', 'gvkey', 'permco', 'permno', 'valid_from', 'valid_to']]
+    out['gvkey'] = out.gvkey.fillna(-1)
+    out = out.drop_duplicates().sort_values(['issuer', 'valid_from', 'permco', 'permno'])
+    return out.astype({'issuer':np.int64, 'gvkey':np.int32, 'permco':np.int32, 'permno':np.int32}).reset_index(drop=True)
+
+#---------------------------
+# Store
+#---------------------------
+
+## a new version next to the older ones, named by build date
+def write_bridge(bridge, path=BRIDGE_DIR, version=None):
+    version = version or pd.Timestamp.now().strftime("%Y%m%d%H%M%S")
+    os.makedirs(path, exist_ok=True)
+    table = pa.Table.from_pandas(bridge, preserve_index=False)
+    table = table.set_column(table.schema.get_field_index('valid_from'), 'valid_from', table['valid_from'].cast(pa.date32()))
+    table = table.set_column(table.schema.get_field_index('valid_to'), 'valid_to', table['valid_to'].cast(pa.date32()))
+    meta = {"bridge_version":BRIDGE_VERSION, "version":version, "rows":len(bridge)}
+    table = table.replace_schema_metadata({"cusip_bridge":json.dumps(meta)})
+    f = os.path.join(path, "bridge_%s.parquet" % version)
+    pq.write_table(table, f + ".tmp")
+    os.replace(f + ".tmp", f)
+    return f
+
+def bridge_versions(path=BRIDGE_DIR):
+    return sorted(os.path.basename(f)[7:-8] for f in glob.glob(os.path.join(path, "bridge_*.parquet")))
+
+## the latest version, or the one asked for
+def read_bridge(path=BRIDGE_DIR, version=None):
+    versions = bridge_versions(path)
+    if not versions:
+        raise FileNotFoundError("no bridge under " + path + ", build one with python3 cusip_bridge.py")
+    version = version or versions[-1]
+    table = pq.read_table(os.path.join(path, "bridge_%s.parquet" % version))
+    meta = json.loads(table.schema.metadata[b"cusip_bridge"])
+    if meta["bridge_version"] != BRIDGE_VERSION:
+        raise ValueError("bridge %s has layout %s, expected %s" % (version, meta["bridge_version"], BRIDGE_VERSION))
+    return table.to_pandas(date_as_object=False)
+
+#---------------------------
+# Lookup
+#---------------------------
+
+## days since 1970 and the (issuer, day) search key
+def _days(dates):
+    return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype(np.int64)
+
+def _key(issuer, day):
+    return np.asarray(issuer, dtype=np.int64)*2**17 + (day + 2**16)
+
+## permco (or another bridge key) of each issuer on each date, -1 when no
+## link is valid; where links overlap, the covering link that started last is
+## used: the search starts at the last link started by the date and steps back
+## through the issuer's earlier links until one is still valid
+def bridge_lookup(bridge, issuer, dates, key='permco'):
+    start = _key(bridge.issuer.to_numpy(), _days(bridge.valid_from))
+    order = np.argsort(start, kind='stable')
+    start = start[order]
+    b_issuer = bridge.issuer.to_numpy()
+    b_to = _days(bridge.valid_to)
+    b_key = bridge[key].to_numpy()
+
+    issuer = np.asarray(issuer, dtype=np.int64)
+    dates = pd.Series(pd.to_datetime(dates))
+    day = _days(dates.fillna(OPEN_END))
+    pos = np.searchsorted(start, _key(issuer, day), side='right') - 1
+    out = np.full(len(day), -1, dtype=np.int64)
+
+    todo = np.flatnonzero((pos >= 0) & (issuer >= 0) & dates.notna().to_numpy())
+    pos = pos[todo]
+    while todo.size:
+        row = order[pos]
+        same = b_issuer[row] == issuer[todo]
+        hit = same & (b_to[row] >= day[todo])
+        out[todo[hit]] = b_key[row[hit]]
+        more = same & ~hit & (pos > 0)
+        todo = todo[more]; pos = pos[more] - 1
+    return out
+
+## int64 sort key of a firm and month, months since 1970
+def firm_month(firm, dates):
+    month = pd.to_datetime(dates).to_numpy().astype('datetime64[M]').astype(np.int64)
+    return np.asarray(firm, dtype=np.int64)*2**12 + (month + 2**11)
+
+## last row (by date) of each firm and month, e.g. the month end DD, and the
+## sorted firm-month keys of those rows
+def last_by_firm_month(df, firm='permco', date='date'):
+    key = firm_month(df[firm], df[date])
+    order = np.lexsort([pd.to_datetime(df[date]).to_numpy(), key])
+    key = key[order]
+    last = np.flatnonzero(np.r_[key[1:] != key[:-1], True]) if len(key) else order
+    return df.iloc[order[last]].reset_index(drop=True), key[last]
+
+## left merge of columns of right (one row per sorted right_key) onto left by
+## firm-month key, as a searchsorted lookup
+def merge_firm_month(left, left_key, right, right_key, columns):
+    pos = np.searchsorted(right_key, left_key)
+    found = pos < len(right_key)
+    found[found] = right_key[pos[found]] == left_key[found]
+    matched = right[columns].reindex(np.where(found, pos, -1)).reset_index(drop=True)
+    return pd.concat([left.reset_index(drop=True), matched], axis=1)
+
+if __name__ == "__main__":
+    import wrds
+    path = sys.argv[1] if len(sys.argv) > 1 else BRIDGE_DIR
+    db = wrds.Connection()
+    bridge = build_bridge(db.raw_sql(STOCKNAMES_SQL), db.raw_sql(LINK_SQL))
+    db.close()
+    f = write_bridge(bridge, path)
+    print("wrote", f, len(bridge), "rows,", bridge.issuer.nunique(), "issuers")
@@ -0,0 +1,187 @@
+#------------------------------------------
+# Out of core OLS for the EBP spread
+# regression
+# chunks of bond-months are folded into
+# the triangular factor of [X y], so memory
+# is fixed by the number of regressors and
+# not by the number of bond-months
+#------------------------------------------
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import solve_triangular
+
+## regressors of the log spread, a constant is added in front
+REGRESSORS = ['DD', 'lduration', 'lparvalue', 'lcoupon', 'lage',
+              'call', 'call_dd', 'call_lduration', 'call_lparvalue', 'call_lcoupon', 'call_lage']
+
+## rows per chunk when a frame in memory is streamed through the engine
+CHUNK_ROWS = 250000
+
+#---------------------------
+# Regression variables
+#---------------------------
+
+## log spread, logs of the bond characteristics and their interactions with
+## the call dummy, added to df in place
+def spread_features(df):
+    df['trd_exctn_dt'] = pd.to_datetime(df['trd_exctn_dt'])
+    df['offering_date'] = pd.to_datetime(df['offering_date'])
+
+    df['age'] = (df['trd_exctn_dt'] - df['offering_date']).dt.days
+
+    df['call'] = df['redeemable'].map({'Y': 1, 'N': 0}).astype(int)
+
+    df['lspr'] = np.log(df['rf_spread'])
+    df['lduration'] = np.log(df['duration_mac'])
+    df['lparvalue'] = np.log(df['principal_amt'])
+    df['lcoupon'] = np.log(df['coupon'])
+    df['lage'] = np.log(df['age'])
+
+    df['call_dd'] = df['call'] * df['DD']
+    df['call_lduration'] = df['call'] * df['lduration']
+    df['call_lparvalue'] = df['call'] * df['lparvalue']
+    df['call_lcoupon'] = df['call'] * df['lcoupon']
+    df['call_lage'] = df['call'] * df['lage']
+    return df
+
+## a frame in memory as a stream of row slices
+def frame_chunks(df, rows=CHUNK_ROWS):
+    for i in range(0, len(df), rows):
+        yield df.iloc[i:i + rows]
+
+## constant (unless absorbed by fixed effects) plus regressors, and the rows
+## with a finite y and X
+def design(chunk, xcols=REGRESSORS, ycol='lspr', const=True):
+    X = np.column_stack([np.ones(len(chunk))]*const + [chunk[c].to_numpy(dtype=float) for c in xcols])
+    y = chunk[ycol].to_numpy(dtype=float)
+    return X, y, np.isfinite(X).all(axis=1) & np.isfinite(y)
+
+#---------------------------
+# Fit
+#---------------------------
+
+## first pass: R of the QR of [X y] over all complete rows
+## R'R is the cross product [X y]'[X y], i.e. X'X, X'y and y'y, but carrying
+## the factor instead of the products keeps the accuracy of a QR solve
+def ols_accumulate(chunks, xcols=REGRESSORS, ycol='lspr'):
+    k = len(xcols) + 1
+    R = np.zeros((0, k + 1))
+    n = 0
+    for chunk in chunks:
+        X, y, ok = design(chunk, xcols, ycol)
+        if not ok.any():
+            continue
+        Z = np.column_stack([X[ok], y[ok]])
+        R = np.linalg.qr(np.vstack([R, Z]), mode='r')
+        n += int(ok.sum())
+    if R.shape[0] < k + 1:
+        R = np.vstack([R, np.zeros((k + 1 - R.shape[0], k + 1))])
+    return {"R":R[:k + 1], "n":n, "xcols":["const"] + list(xcols), "ycol":ycol}
+
+## coefficients and residual variance from the accumulated factor
+## a rank deficient X falls back to the minimum norm solution, as pinv does
+## absorbed counts the degrees of freedom taken by fixed effects
+def ols_solve(stats, tol=1e-12):
+    R, n, names = stats["R"], stats["n"], stats["xcols"]
+    k = len(names)
+    Rx, ry, ryy = R[:k, :k], R[:k, k], R[k, k]
+    d = np.abs(np.diag(Rx))
+    rank = int((d > tol*max(d.max(), 1.0)).sum()) if k else 0
+    if rank == k:
+        beta = solve_triangular(Rx, ry)
+    else:
+        beta = np.linalg.lstsq(Rx, ry, rcond=None)[0]
+        rank = np.linalg.matrix_rank(Rx)
+    ssr = ryy**2
+    df_resid = n - rank - stats.get("absorbed", 0)
+    return {"params":pd.Series(beta, index=names), "ssr":ssr, "nobs":n, "rank":rank,
+            "df_resid":df_resid, "sig2":ssr/df_resid, "xcols":[c for c in names if c != "const"],
+            "ycol":stats["ycol"]}
+
+def ols_fit(chunks, xcols=REGRESSORS, ycol='lspr'):
+    return ols_solve(ols_accumulate(chunks, xcols, ycol))
+
+#---------------------------
+# Predict
+#---------------------------
+
+## second pass: predicted log spread, the spread with the 0.5*sig2 lognormal
+## correction and the excess bond premium, added to each chunk
+## rows missing a regressor get NaN, as in statsmodels predict
+def ols_predict(chunks, fit, spread='rf_spread'):
+    beta = fit["params"].to_numpy()
+    for chunk in chunks:
+        X = design(chunk, fit["xcols"], fit["ycol"], const="const" in fit["params"].index)[0]
+        chunk = chunk.copy()
+        chunk['lspr_p'] = X @ beta
+        chunk['spr_p'] = np.exp(chunk['lspr_p'] + 0.5*fit["sig2"])
+        chunk['ebp_oa'] = chunk[spread] - chunk['spr_p']
+        yield chunk
+
+#---------------------------
+# Absorbed fixed effects
+#---------------------------
+
+## a column has converged when a sweep moves no value by more than FE_TOL
+## times its largest absolute value
+FE_TOL = 1e-12
+FE_MAXITER = 10000
+
+## integer codes per fixed effect column, -1 where missing
+def fe_codes(df, fe_cols):
+    return [pd.factorize(df[c])[0] for c in fe_cols]
+
+## within transformation by alternating projections: subtract the group means
+## of one fixed effect after another until a sweep changes nothing
+## codes are 0..G-1 with every level present, M (rows x columns) is changed
+## in place, one column at a time, and returned with the most sweeps taken
+def demean(M, codes, tol=FE_TOL, maxiter=FE_MAXITER):
+    counts = [np.bincount(c) for c in codes]
+    sweeps = 0
+    for j in range(M.shape[1]):
+        x = M[:, j]
+        scale = max(np.abs(x).max(initial=0), 1.0)
+        for it in range(1, maxiter + 1):
+            change = 0.0
+            for c, n in zip(codes, counts):
+                d = (np.bincount(c, weights=x, minlength=len(n))/n)[c]
+                x -= d
+                change = max(change, np.abs(d).max(initial=0))
+            if len(codes) == 1 or change < tol*scale:
+                break
+        sweeps = max(sweeps, it)
+    return M, sweeps
+
+## log spread regression with the fe_cols fixed effects absorbed, no dummy
+## columns are built
+## returns the fit and df with lspr_p (X b plus the fixed effects), spr_p and
+## ebp_oa, NaN on rows missing a regressor or a fixed effect
+## the absorbed degrees of freedom are the levels less one per extra fixed
+## effect, exact when the fixed effects form one connected set
+def fe_fit(df, fe_cols, xcols=REGRESSORS, ycol='lspr', spread='rf_spread', tol=FE_TOL):
+    X, y, ok = design(df, xcols, ycol, const=False)
+    codes = fe_codes(df, fe_cols)
+    for c in codes:
+        ok &= c >= 0
+    codes = [pd.factorize(c[ok])[0] for c in codes]
+
+    raw = np.asfortranarray(np.column_stack([X[ok], y[ok]]))
+    M, sweeps = demean(raw.copy(order='F'), codes, tol)
+    R = np.linalg.qr(M, mode='r')
+    k = len(xcols)
+    if R.shape[0] < k + 1:
+        R = np.vstack([R, np.zeros((k + 1 - R.shape[0], k + 1))])
+    absorbed = sum(int(c.max()) + 1 for c in codes if len(c)) - max(len(codes) - 1, 0)
+    fit = ols_solve({"R":R, "n":int(ok.sum()), "xcols":list(xcols), "ycol":ycol, "absorbed":absorbed})
+    fit.update(fe_cols=list(fe_cols), levels=[int(c.max()) + 1 if len(c) else 0 for c in codes], sweeps=sweeps)
+
+    ## fitted log spread is y less the within residual
+    beta = fit["params"].to_numpy()
+    lspr_p = np.full(len(df), np.nan)
+    lspr_p[ok] = raw[:, k] - (M[:, k] - M[:, :k] @ beta)
+    df = df.copy()
+    df['lspr_p'] = lspr_p
+    df['spr_p'] = np.exp(df['lspr_p'] + 0.5*fit["sig2"])
+    df['ebp_oa'] = df[spread] - df['spr_p']
+    return fit, df
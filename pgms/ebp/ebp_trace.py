@@ -0,0 +1,184 @@
+#------------------------------------------
+# Streaming loader for the enhanced TRACE
+# trades with FISD characteristics
+# only the needed columns are parsed and
+# trades outside the date range are
+# dropped batch by batch
+#------------------------------------------
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from cusip_bridge import cusip6_code
+
+## columns the spread regression reads
+TRACE_COLS = ['cusip_id', 'trd_exctn_dt', 'rf_spread', 'duration_mac', 'principal_amt',
+              'coupon', 'offering_date', 'redeemable']
+
+## read as well when the file has them: trade time orders trades within a
+## day, entered volume weights the spread, issuer is the integer CUSIP6
+## added by trace_to_parquet
+OPTIONAL_COLS = ['trd_exctn_tm', 'entrd_vol_qt', 'issuer']
+
+## types fixed up front so nothing is guessed from the first block
+TRACE_TYPES = {'cusip_id':pa.string(), 'trd_exctn_dt':pa.date32(), 'offering_date':pa.date32(),
+               'redeemable':pa.string(), 'rf_spread':pa.float64(), 'duration_mac':pa.float64(),
+               'principal_amt':pa.float64(), 'coupon':pa.float64(),
+               'trd_exctn_tm':pa.string(), 'entrd_vol_qt':pa.float64()}
+
+## bytes of text parsed per batch
+BLOCK_MB = 64
+
+## first and last day of a month, or of the whole history when year is None
+def month_range(year=None, month=None):
+    if year is None:
+        return None, None
+    start = pd.Timestamp(year=int(year), month=int(month), day=1)
+    return start, start + pd.offsets.MonthEnd(0)
+
+def _date_filter(start, end, col='trd_exctn_dt'):
+    expr = None
+    if start is not None:
+        expr = ds.field(col) >= pa.scalar(pd.Timestamp(start).date(), pa.date32())
+    if end is not None:
+        e = ds.field(col) <= pa.scalar(pd.Timestamp(end).date(), pa.date32())
+        expr = e if expr is None else expr & e
+    return expr
+
+## pipe delimited text: pyarrow parses BLOCK_MB at a time, only columns are
+## converted and each batch is filtered on trade date before it is kept
+def _read_psv(path, columns, start, end, block_mb):
+    reader = pv.open_csv(path,
+                         read_options=pv.ReadOptions(block_size=block_mb*2**20),
+                         parse_options=pv.ParseOptions(delimiter="|"),
+                         convert_options=pv.ConvertOptions(include_columns=columns,
+                                                           column_types={c: t for c, t in TRACE_TYPES.items() if c in columns},
+                                                           strings_can_be_null=True))
+    lo = None if start is None else pa.scalar(pd.Timestamp(start).date(), pa.date32())
+    hi = None if end is None else pa.scalar(pd.Timestamp(end).date(), pa.date32())
+    kept = []
+    for batch in reader:
+        date = batch.column(batch.schema.get_field_index('trd_exctn_dt'))
+        mask = None
+        if lo is not None:
+            mask = pc.greater_equal(date, lo)
+        if hi is not None:
+            m = pc.less_equal(date, hi)
+            mask = m if mask is None else pc.and_(mask, m)
+        if mask is not None:
+            batch = batch.filter(mask)
+        if batch.num_rows > 0:
+            kept.append(batch)
+    return pa.Table.from_batches(kept, schema=reader.schema)
+
+## column names in the .psv header or the parquet schema
+def trace_columns(path):
+    if os.path.isdir(path) or path.endswith(".parquet"):
+        return ds.dataset(path, format="parquet").schema.names
+    with open(path) as f:
+        return f.readline().rstrip("\r\n").split("|")
+
+## TRACE trades with trade dates in [start, end] and only the given columns
+## path is the .psv file, or a parquet file or directory from trace_to_parquet
+## whose row group statistics let whole row groups be skipped
+def read_trace(path, start=None, end=None, columns=TRACE_COLS, block_mb=BLOCK_MB):
+    have = trace_columns(path)
+    columns = list(dict.fromkeys(list(columns) + ['trd_exctn_dt'] + [c for c in OPTIONAL_COLS if c in have]))
+    if os.path.isdir(path) or path.endswith(".parquet"):
+        table = ds.dataset(path, format="parquet").to_table(columns=columns, filter=_date_filter(start, end))
+    else:
+        table = _read_psv(path, columns, start, end, block_mb)
+    return table.to_pandas(date_as_object=False)
+
+## one time conversion of the .psv to parquet, one row group per parsed block
+## so later reads prune on trade date (best when the file is in date order)
+## the integer issuer CUSIP6 (cusip_bridge.py) is added once here
+def trace_to_parquet(path, out, columns=None, block_mb=BLOCK_MB):
+    reader = pv.open_csv(path,
+                         read_options=pv.ReadOptions(block_size=block_mb*2**20),
+                         parse_options=pv.ParseOptions(delimiter="|"),
+                         convert_options=pv.ConvertOptions(include_columns=columns or [],
+                                                           column_types=TRACE_TYPES, strings_can_be_null=True))
+    schema = reader.schema.append(pa.field('issuer', pa.int64()))
+    n = 0
+    with pq.ParquetWriter(out + ".tmp", schema) as writer:
+        for batch in reader:
+            issuer = cusip6_code(batch.column(batch.schema.get_field_index('cusip_id')).to_pandas())
+            writer.write_batch(pa.RecordBatch.from_arrays(batch.columns + [pa.array(issuer)], schema=schema))
+            n += batch.num_rows
+    os.replace(out + ".tmp", out)
+    return n
+
+#---------------------------
+# Bond-month aggregation
+#---------------------------
+
+## ways to collapse a bond's trades in a month to one spread
+##   last     spread of the last trade in the month
+##   vw       volume weighted mean spread (plain mean without volumes)
+##   trimmed  median after dropping the trim share of trades at each end
+AGGREGATIONS = ["last", "vw", "trimmed"]
+
+## one row per bond (cusip_id) and month: the month's last trade with its
+## characteristics, rf_spread replaced by the chosen aggregate, plus the
+## number of trades and total volume
+def bond_month(trades, how="last", trim=0.1):
+    if how not in AGGREGATIONS:
+        raise ValueError("how must be one of " + ", ".join(AGGREGATIONS))
+
+    ## trades in bond, month, time order
+    date = pd.to_datetime(trades['trd_exctn_dt'])
+    month = (date.dt.year*12 + date.dt.month - 1).to_numpy()
+    bond = pd.factorize(trades['cusip_id'])[0]
+    keys = [date.to_numpy(), month, bond]
+    if 'trd_exctn_tm' in trades:
+        keys = [trades['trd_exctn_tm'].astype(str).to_numpy()] + keys
+    order = np.lexsort(keys)
+    bond = bond[order]; month = month[order]
+    spread = trades['rf_spread'].to_numpy(dtype=float)[order]
+    volume = trades['entrd_vol_qt'].to_numpy(dtype=float)[order] if 'entrd_vol_qt' in trades \
+        else np.full(len(order), np.nan)
+
+    ## group boundaries in the sorted trades
+    new = np.r_[True, (bond[1:] != bond[:-1]) | (month[1:] != month[:-1])] if len(order) else np.zeros(0, bool)
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:], len(order)] - 1
+    group = np.cumsum(new) - 1
+    n = last - first + 1
+
+    out = trades.iloc[order[last]].reset_index(drop=True)
+    out['n_trades'] = n
+    out['volume'] = np.bincount(group, weights=np.nan_to_num(volume), minlength=len(first))
+
+    if how == "vw":
+        ok = np.isfinite(spread) & np.isfinite(volume) & (volume > 0)
+        w = np.where(ok, volume, 0.0)
+        vw = np.bincount(group, weights=w*np.where(ok, spread, 0), minlength=len(first))
+        total = np.bincount(group, weights=w, minlength=len(first))
+        fin = np.isfinite(spread)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(group, weights=np.where(fin, spread, 0), minlength=len(first)) / \
+                np.bincount(group, weights=fin.astype(float), minlength=len(first))
+            out['rf_spread'] = np.where(total > 0, vw/total, mean)
+
+    elif how == "trimmed":
+        ## spreads sorted within group (missing last), then the middle of the kept ones
+        fin = np.isfinite(spread)
+        within = np.lexsort([np.where(fin, spread, np.inf), group])
+        s = spread[within]
+        m = np.bincount(group, weights=fin.astype(float), minlength=len(first)).astype(int)
+        cut = np.floor(trim*m).astype(int)
+        kept = m - 2*cut
+        lo = first + cut + (kept - 1)//2
+        hi = first + cut + kept//2
+        med = np.full(len(first), np.nan)
+        ok = kept > 0
+        med[ok] = 0.5*(s[lo[ok]] + s[hi[ok]])
+        out['rf_spread'] = med
+
+    return out
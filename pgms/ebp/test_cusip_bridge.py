@@ -0,0 +1,57 @@
+#------------------------------------------
+# The integer CUSIP6 bridge merge against
+# the string merge wrds_ebp.py used before
+#
+# usage: python3 -m pytest test_cusip_bridge.py
+#------------------------------------------
+
+import numpy as np
+import pandas as pd
+from cusip_bridge import build_bridge, bridge_lookup, cusip6_code, firm_month, last_by_firm_month, merge_firm_month
+
+## issuer 123456 has two share classes under permco 10 whose links overlap:
+## permno 1 for 1990-2099 and permno 2 for 2005-2010; issuer 654321 has one
+def _bridge():
+    stocknames = pd.DataFrame({"permno":[1, 2, 3], "permco":[10, 10, 30],
+                               "ncusip":["12345610", "12345620", "65432110"],
+                               "cusip":["12345610", "12345620", "65432110"],
+                               "namedt":pd.to_datetime(["1990-01-01", "2005-01-01", "1995-01-01"]),
+                               "nameenddt":pd.to_datetime(["2099-12-31", "2010-12-31", "2099-12-31"])})
+    links = pd.DataFrame({"gvkey":["001000", "001000", "003000"], "permno":[1, 2, 3],
+                          "linkdt":pd.to_datetime(["1990-01-01", "2005-01-01", "1995-01-01"]),
+                          "linkenddt":[pd.NaT, pd.Timestamp("2010-12-31"), pd.NaT]})
+    return build_bridge(stocknames, links)
+
+def test_overlapping_links():
+    issuer = cusip6_code(["123456", "123456", "123456", "654321", "999999"])
+    dates = pd.to_datetime(["2000-06-30", "2007-06-30", "2015-06-30", "2015-06-30", "2015-06-30"])
+    assert bridge_lookup(_bridge(), issuer, dates).tolist() == [10, 10, 10, 30, -1]
+
+def test_merge_matches_string_merge():
+    rng = np.random.default_rng(0)
+
+    ## DD output: daily rows of permno 1 and 3 across the overlap
+    days = pd.bdate_range("2004-11-01", "2011-03-31")
+    dd = pd.concat([pd.DataFrame({"permco":10, "cusip":"12345610", "date":days}),
+                    pd.DataFrame({"permco":30, "cusip":"65432110", "date":days})], ignore_index=True)
+    dd["DD"] = rng.normal(size=len(dd))
+
+    ## bond-months of both issuers and of an issuer with no firm
+    n = 400
+    trace = pd.DataFrame({"cusip_id":rng.choice(["123456AB1", "123456CD2", "654321EF3", "999999GH4"], n),
+                          "trd_exctn_dt":rng.choice(days, n)})
+
+    ## before: CUSIP6 strings and Periods
+    old_t = trace.assign(cusip=trace.cusip_id.str[:6].str.upper().str.strip(),
+                         month_year=trace.trd_exctn_dt.dt.to_period('M'))
+    old_d = dd.assign(cusip=dd.cusip.str[:6].str.upper().str.strip(), month_year=dd.date.dt.to_period('M'))
+    old_last = old_d.sort_values(['cusip', 'date']).groupby(['cusip', 'month_year']).tail(1)
+    old = old_t.merge(old_last[['cusip', 'month_year', 'DD']], on=['cusip', 'month_year'], how='left')
+
+    ## now: integer issuer, bridge permco and firm-month keys
+    trace['permco'] = bridge_lookup(_bridge(), cusip6_code(trace.cusip_id), trace.trd_exctn_dt)
+    dd_last, dd_key = last_by_firm_month(dd, 'permco', 'date')
+    new = merge_firm_month(trace, firm_month(trace.permco, trace.trd_exctn_dt), dd_last, dd_key, ['DD'])
+
+    assert old.DD.notna().sum() > 0
+    np.testing.assert_array_equal(new.DD.to_numpy(), old.DD.to_numpy())
@@ -1,9 +1,33 @@
+import sys
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
+from ebp_trace import TRACE_COLS, read_trace, month_range, bond_month
+from ebp_ols import spread_features, frame_chunks, ols_fit, ols_predict, fe_fit
+from cusip_bridge import cusip6_code, read_bridge, bridge_lookup, firm_month, last_by_firm_month, merge_firm_month
+
+## month to run (YEAR MONTH from wrds_ebp.sh), the whole history when not given
+year = sys.argv[1] if len(sys.argv) > 2 else None
+month = sys.argv[2] if len(sys.argv) > 2 else None
+start, end = month_range(year, month)
+print("Trade dates:", start, "to", end)
+
+## spread of a bond-month (AGG from wrds_ebp.sh): last, vw or trimmed, see ebp_trace.py
+how = sys.argv[3] if len(sys.argv) > 3 else "last"
+print("Bond-month spread:", how)
+
+## fixed effects absorbed in the spread regression (FE from wrds_ebp.sh), comma
+## separated, e.g. gsubind,rating,month_year: gsubind comes with the DD
+## output, month_year is the trade month, anything else is read from the
+## TRACE file; none gives the plain OLS with a constant
+fe_cols = [c for c in (sys.argv[4] if len(sys.argv) > 4 else "").split(",") if c]
+dd_cols = ['permco', 'month_year', 'DD'] + [c for c in fe_cols if c == 'gsubind']
+trace_cols = TRACE_COLS + [c for c in fe_cols if c not in dd_cols]
+print("Fixed effects:", fe_cols or "none")
 
 #Get redeemable merged in
-iter_df = pd.read_csv("./test_iter_cusip_2020_2025.txt", sep="|")
+## typed parquet dataset from merton_DD.py, only the columns and months used here
+filters = None if start is None else [('year_month', '==', start.strftime("%Y-%m"))]
+iter_df = pd.read_parquet("./test_iter_cusip_2020_2025", columns=['permco', 'date'] + dd_cols[2:], filters=filters)
 #print("AHHH:", iter_df['DD'].unique)
 #trace_fisd = pd.read_csv("/scratch/frbkc/trace_enhanced_rf_spreads.psv", sep="|")
 #trace_fisd_plus = pd.read_csv("/scratch/frbkc/trace_enhanced_with_fisd_characteristics.psv", sep="|")
@@ -11,58 +35,45 @@ iter_df = pd.read_csv("./test_iter_cusip_2020_2025.txt", sep="|")
 #lookup = (trace_fisd_plus.groupby(key)['redeemable'].first())
 #trace_fisd['redeemable'] = trace_fisd.set_index(key).index.map(lookup)
 #trace_fisd.to_csv("/scratch/frbkc/trace_fisd_full.psv", sep="|", index=False)
-trace_fisd = pd.read_csv("/scratch/frbkc/trace_fisd_full.psv", sep="|")
+#trace_fisd = pd.read_csv("/scratch/frbkc/trace_fisd_full.psv", sep="|")
+## streamed: regression columns only, trades outside the month dropped while parsing
+trace_fisd = read_trace("/scratch/frbkc/trace_fisd_full.psv", start, end, columns=trace_cols)
+print("Trades:", len(trace_fisd))
 
+## one observation per bond and month before the DD merge
+trace_fisd = bond_month(trace_fisd, how=how)
+print("Bond-months:", len(trace_fisd))
 
-#merge on cusip and trade date. 
-#trace_fisd = trace_fisd.rename(columns={'cusip6':'cusip'})
-trace_fisd['cusip'] = trace_fisd['cusip_id'].str[:6] #maybe use in logic later?
-iter_df['cusip'] = iter_df['cusip'].str[:6] #maybe use in logic later?
-trace_fisd['cusip'] = trace_fisd['cusip'].str.upper().str.strip()
-iter_df['cusip'] = iter_df['cusip'].str.upper().str.strip()
 
-print("TRACE FISD CUSIP:", trace_fisd['cusip'])
-print("DD CUSIP:", iter_df['cusip'])
-
-common_cusip = set(trace_fisd['cusip']) & set(iter_df['cusip'])
-print("Common cusip count:", len(common_cusip))
-
-
-iter_df['date'] = pd.to_datetime(iter_df['date'])
-iter_df['month_year'] = iter_df['date'].dt.to_period('M')
-dd_last = (
-    iter_df
-    .sort_values(['cusip', 'date'])
-    .groupby(['cusip', 'month_year'])
-    .tail(1))
+#merge on firm and trade month
+## issuer CUSIP6 as an integer, carried by the parquet TRACE file, coded here
+## for the bond-months when reading the .psv
+if 'issuer' not in trace_fisd:
+    trace_fisd['issuer'] = cusip6_code(trace_fisd['cusip_id'])
 
+## firm of each bond-month from the bridge (cusip_bridge.py), the DD output
+## already carries permco
+bridge = read_bridge("./cusip_bridge")
 trace_fisd['trd_exctn_dt'] = pd.to_datetime(trace_fisd['trd_exctn_dt'])
-trace_fisd['month_year'] = trace_fisd['trd_exctn_dt'].dt.to_period('M')
+trace_fisd['permco'] = bridge_lookup(bridge, trace_fisd['issuer'], trace_fisd['trd_exctn_dt'])
+print("Bond-months without a firm:", (trace_fisd['permco'] < 0).sum())
 
+## last DD per firm and month, on an integer firm-month key
+iter_df['date'] = pd.to_datetime(iter_df['date'])
+dd_last, dd_key = last_by_firm_month(iter_df, 'permco', 'date')
 
-'''print("--------------------------------------------------------")
-print(trace_fisd['cusip'].dtype, dd_last['cusip'].dtype)
-print(trace_fisd['cusip'].head())
-print(dd_last['cusip'].head())
-print(trace_fisd['trd_exctn_dt'].dt.to_period('M').head())
-print(dd_last['date'].dt.to_period('M').head())
-print("--------------------------------------------------------")'''
-
-common_month_year = set(trace_fisd['month_year']) & set(dd_last['month_year'])
-print("Common month year count:", len(common_month_year))
-
-#print("TRACE unique lengths:", trace_fisd['cusip'].str.len().value_counts())
-#print("DD unique lengths:", dd_last['cusip'].str.len().value_counts())
+## month as an integer, also the month_year fixed effect
+trace_fisd['month_year'] = trace_fisd['trd_exctn_dt'].to_numpy().astype('datetime64[M]').astype(np.int64)
+trace_key = firm_month(trace_fisd['permco'], trace_fisd['trd_exctn_dt'])
 
-#print("TRACE fisd month year range:", trace_fisd['month_year'].min(), "to", trace_fisd['month_year'].max())
-#print("DD month year range:", dd_last['month_year'].min(), "to", dd_last['month_year'].max())
+print("Common firm count:", len(np.intersect1d(trace_fisd['permco'], dd_last['permco'])))
+print("Common month year count:", len(np.intersect1d(trace_fisd['month_year'],
+                                                    dd_last['date'].to_numpy().astype('datetime64[M]').astype(np.int64))))
 print("dd_last shape:", dd_last.shape)
 print("trace_fisd shape:", trace_fisd.shape)
 
-merged = trace_fisd.merge(
-    dd_last[['cusip', 'month_year', 'DD']],
-    on=['cusip', 'month_year'],
-    how='left')
+## left merge as a sorted integer lookup
+merged = merge_firm_month(trace_fisd, trace_key, dd_last, dd_key, dd_cols[2:])
 print("Merged shape:", merged.shape)
 #print("with dd merge shape:", merged.shape)
 #print(merged.keys())
@@ -85,38 +96,19 @@ print(df[:20])
 #trace_fisd = trace_fisd.rename(columns={'cusip_id': 'cusip'})
 #df = trace_fisd.merge(iter_df, on=['cusip'], suffixes=('_trace', '_iter'))
 
-df['trd_exctn_dt'] = pd.to_datetime(df['trd_exctn_dt'])
-df['offering_date'] = pd.to_datetime(df['offering_date'])
-
-df['age'] = (df['trd_exctn_dt'] - df['offering_date']).dt.days
-
-df['call'] = df['redeemable'].map({'Y': 1, 'N': 0}).astype(int)
-
-df['lspr'] = np.log(df['rf_spread'])
-df['lduration'] = np.log(df['duration_mac'])
-df['lparvalue'] = np.log(df['principal_amt'])
-df['lcoupon'] = np.log(df['coupon'])
-df['lage'] = np.log(df['age'])
-
-df['call_dd'] = df['call'] * df['DD']
-df['call_lduration'] = df['call'] * df['lduration']
-df['call_lparvalue'] = df['call'] * df['lparvalue']
-df['call_lcoupon'] = df['call'] * df['lcoupon']
-df['call_lage'] = df['call'] * df['lage']
-
-X = df[['DD', 'lduration', 'lparvalue', 'lcoupon', 'lage', 
-        'call', 'call_dd', 'call_lduration', 'call_lparvalue', 'call_lcoupon', 'call_lage']]
-
-X = sm.add_constant(X)
-y = df['lspr']
-
-model = sm.OLS(y, X, missing='drop').fit()
-df['lspr_p'] = model.predict(X)
-
-sig2 = model.mse_resid
-df['spr_p'] = np.exp(df['lspr_p'] + 0.5*sig2)
-
-df['ebp_oa'] = df['rf_spread'] - df['spr_p']
+spread_features(df)
+
+if fe_cols:
+    ## fixed effects absorbed by alternating projections, no dummy columns
+    fit, df = fe_fit(df, fe_cols)
+    print("Fixed effect levels:", dict(zip(fit["fe_cols"], fit["levels"])), "sweeps:", fit["sweeps"])
+else:
+    ## out of core OLS: the bond-months are streamed through the fit in chunks,
+    ## then again for lspr_p, spr_p (with 0.5*sig2) and ebp_oa
+    fit = ols_fit(frame_chunks(df))
+    df = pd.concat(ols_predict(frame_chunks(df), fit))
+print(fit["params"])
+print("Observations:", fit["nobs"], "sig2:", fit["sig2"])
 
 print(df['ebp_oa'][:100])
 
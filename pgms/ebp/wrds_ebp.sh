@@ -7,5 +7,12 @@
 
 YEAR=1988
 MONTH=4
+## bond-month spread: last, vw or trimmed
+AGG=last
+## fixed effects to absorb, comma separated (e.g. gsubind,rating,month_year), empty for none
+FE=
 
-python3 wrds_ebp.py "$YEAR" "$MONTH"
+## rebuild the CUSIP6 to firm bridge (new version under ./cusip_bridge) when CRSP names update
+#python3 cusip_bridge.py ./cusip_bridge
+
+python3 wrds_ebp.py "$YEAR" "$MONTH" "$AGG" "$FE"
@@ -6,8 +6,20 @@
 #$ -l m_mem_free=6G
 source ~/virtualenv/base_python/bin/activate
 
-#python3 merton_data_wrds.py
-#python3 merton_data_wrds_two.py
-python3 merton_DD.py
+## incremental (rows past the stored high-water marks) or full
+#python3 merton_data_wrds.py incremental
+## memory or stream (out of core within a budget in MB)
+#python3 merton_data_wrds_two.py stream 4096
+## full, resume (continue an interrupted run of the same input and settings)
+## or incremental (new month ends only); resume and incremental stop if the
+## store was written with other input, code or settings
+MODE=full
+## sigma_V update for the iterated method: picard, aitken or anderson
+ACCEL=picard
+## memory budget in MB for the panel, matches m_mem_free
+MEMORY_MB=6144
+## warm or cold start of each month end of the iterated method
+START=warm
+python3 merton_DD.py "$MODE" "$ACCEL" "$MEMORY_MB" "$START"
 deactivate
 
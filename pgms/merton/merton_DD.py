@@ -7,226 +7,61 @@ sys.stdout = log_file
 import datetime
 print("Log created on " + str(datetime.datetime.now()) + '\n')
 
-import os, time, warnings
-import psycopg2
-import numpy as np
+import os
 import pandas as pd
 import multiprocessing as mp
-from scipy.stats import norm
-from scipy.optimize import fsolve
-from scipy.optimize import root
-
-from scipy.optimize import least_squares
-from scipy.optimize import broyden1
+import merton_model
+from merton_model import iter_by_group, sim_inputs_by_group, sim_batch
+from merton_model import SIM_CASCADE, V_CASCADE, ITER_TOL, ITER_MAX
+from merton_scheduler import run_panel, group_bounds
+from merton_telemetry import skipped_by_group, telemetry_table, worker_throughput, write_telemetry, telemetry_summary
+from merton_checkpoint import open_store, write_shard, read_store, pending_panel, run_fingerprint
+from merton_panel import load_panel, write_dataset
+from wrds_extract import cached_frame, wrds_connect, DSI_QUERY
+
+## run mode: full (default), resume or incremental, see merton_checkpoint.py
+mode = sys.argv[1] if len(sys.argv) > 1 else "full"
+print("Run mode:", mode)
+
+## sigma_V update for the iterated method: picard (default), aitken or anderson
+accel = sys.argv[2] if len(sys.argv) > 2 else "picard"
+print("sigma_V update:", accel)
+
+## memory budget in MB for loading the panel
+memory_mb = int(sys.argv[3]) if len(sys.argv) > 3 else 6144
+
+## warm start (default) or cold start of each month end of the iterated
+## method, a warm start only seeds the daily V and matches a cold one
+## (python3 merton_benchmark.py checks) with fewer V evaluations
+warm_start = (sys.argv[4] if len(sys.argv) > 4 else "warm") == "warm"
+print("Warm start:", warm_start)
 os.chdir("./data/compustat/policy/")
 
-#---------------------
-# Database connection
-#---------------------
-dbconn = psycopg2.connect(host = 'wrds-pgdata.wharton.upenn.edu', dbname = 'wrds', port='9737')
-
-#------------------------
-# Simultaneous procedure
-#------------------------
-
-# Simultaneous Merton Model function
-def merton_sim(x, E, D, sigma_E, r, T):
-
-    V = x[0]
-    sigma_V = x[1]
-    
-    d1 = (np.log(V/D) + (r + 0.5*(sigma_V**2))*T)/(sigma_V*np.sqrt(T))
-    d2 = d1 - sigma_V*np.sqrt(T)
-    
-    y1 = E - (V*norm.cdf(d1) - np.exp(-r*T)*D*norm.cdf(d2))
-    y2 = E*sigma_E - V*norm.cdf(d1)*sigma_V
-
-    return [y1, y2]
-
-## single date simultaneous solver
-def sim_process(df, T=1.0):
-    if len(df) < 50:
-        return None
-
-
-    ## Initialize variables
-    row = df.iloc[-1]
-    gvkey = row.gvkey; fyr = row.fyr; permco = row.permco; permno = row.permno; date = row.date.date(); gsubind = row.gsubind; fic = row.fic
-    cusip = row.cusip
-    convergence = False
-
-    ## sort dataframe
-    df = df.sort_values(['gvkey', 'fyr', 'permco', 'permno', 'date'])
-
-    if row.D == 0 or np.isnan(row.D):
-        return None
-
-    ## calculate returns and standard deviations
-    df['E_ret'] = np.log(df.E/df.E.shift(1))*252
-    sigma_E = (df.E_ret/252).std()*np.sqrt(252) #maybe floor it with better reasoning for number
-    if sigma_E < 0.01:
-        sigma_E = 0.01
-
-    sigma_V = sigma_E*(df.E.iloc[-1]/(df.E.iloc[-1]+df.D.iloc[-1]))
-    if sigma_V < 0.01:
-        sigma_V = 0.01
-
-    t0 = time.time()
-    ## Solve the model
-    warnings.simplefilter("error")
-    try: 
-        '''print("sigma_E:", sigma_E)
-        print("Initial sigma_v:", sigma_V)
-        print("initial guess for fsolve:", row.E + row.D, sigma_V)
-        print("E:", row.E, "D:", row.D, "rf:", row.rf)'''
-        fsolve_out = fsolve(merton_sim, x0=np.array([row.E+row.D, sigma_V]), args=(row.E, row.D, sigma_E, row.rf, T))
-        #print("FSOLVE OUT:", fsolve_out)#full_output = True
-        convergence = True
-    except:
-        #print("Error in row: ", (gvkey, fyr, permco, permno, date))
-        fsolve_out = [np.nan, np.nan]
-
-    iteration_time = time.time() - t0
-
-    ## Distance -to-Default and PD
-    if not any(np.isnan(fsolve_out)):
-        DD = (np.log(fsolve_out[0]/row.D) +(row.rf - 0.5*fsolve_out[1])*T)/(fsolve_out[1]*np.sqrt(T))
-        PD = norm.cdf(-DD)
-    else:
-        DD = np.nan; PD = np.nan
-
-    ## return a dictionary 
-    result = {"gvkey":gvkey, "fyr":fyr, "permco":permco, "permno":permno, "date":date, "gsubind":gsubind, "fic":fic,
-              "A":row.A, "E":row.E, "D":row.D, "rf":row.rf, "DD":DD, "PD":PD,
-              "V":fsolve_out[0], "sigma_V":fsolve_out[1],  "convergence":convergence, 
-              "iteration_time":iteration_time, "cusip": cusip}
-    return result
-     
-#------------------------------
-# Two step iterative procedure
-#------------------------------
-
-## firm value solver takes daily inputs
-def merton_iter(V, sigma_V, E, sigma_E, D, rf, T):
-    
-    d1 = (np.log(V/D) + (rf + 0.5*(sigma_V**2))*T)/(sigma_V*np.sqrt(T))
-    d2 = d1 - sigma_V*np.sqrt(T)
-    
-    y = E - (V*norm.cdf(d1) - np.exp(-rf*T)*D*norm.cdf(d2))
-
-    return y
-
-## two step process takes time series inputs by firm
-## df must have: gvkey, date, A, D, E, rf
-def two_step_process(df, T, max_iter=10, tol=0.001):
-    ## Initialize variables
-    last_row = df.iloc[-1]
-    df = df.sort_values(['gvkey', 'fyr', 'permco', 'permno', 'date'])
-    df['E_ret'] = np.log(df.E/df.E.shift(1))*252
-    sigma_E = (df.E_ret/252).std()*np.sqrt(252)
-    sigma_V = sigma_E*(df.E.iloc[-1]/(df.E.iloc[-1]+df.D.iloc[-1]))
-    if sigma_V < 0.01:
-        sigma_V = 0.01
-    df['V'] = np.nan
-    gvkey = last_row.gvkey; fyr = last_row.fyr; permco = last_row.permco; permno = last_row.permno; date = last_row.date.date(); gsubind = last_row.gsubind; fic=last_row.fic
-    cusip = last_row.cusip
-    #print("Processing row:", gvkey, fyr, permco, permno, date)
-    num_iter = 0; converge_check= np.nan; convergence = False; iteration_time = np.nan
-
-    ## start timer
-    t0 = time.time()
-    warnings.simplefilter("error")
-
-    while num_iter <= max_iter:
-        num_iter += 1
-        valid_df = df.loc[df[['E', 'D', 'rf']].notna().all(axis=1)].copy()
-        if valid_df.empty: break
-        def solve_V(row):
-            try:
-                return fsolve(merton_iter, x0=row.E+row.D, args=(sigma_V, row.E, sigma_E, row.D, row.rf, T))[0]
-            except:
-                return np.nan
-        valid_df['V'] = valid_df.apply(solve_V, axis=1)
-        df.loc[valid_df.index,'V'] = valid_df['V']
-        
-        valid_V = df['V'].dropna()
-        if len(valid_V) >= 50:
-            df['V_lag'] = df.V.shift(1)
-            df['V_ret'] = np.log(df.V/df.V_lag)*252
-            mean_V = df.V_ret.mean()
-            sigma_V_prime = (df.V_ret/252).std()*np.sqrt(252)
-
-            ## check tolerance
-            converge_check = np.abs(sigma_V_prime - sigma_V)
-            if converge_check <= tol:
-                convergence = True
-                break
-            else:
-                sigma_V = sigma_V_prime
-        else:
-            convergence = False
-    ## calculate distance to default and probability of default
-    df = df.iloc[-1]
-    if convergence == True:
-        DD = (np.log(df.V/df.D) + (mean_V - 0.5*sigma_V**2))/sigma_V
-        PD = norm.cdf(-DD)
-    else:
-        DD = PD = V = sigma_V = mean_V = np.nan
-    iteration_time = time.time() - t0
-    ## return a dictionary 
-    result = {"gvkey":gvkey, "fyr":fyr, "permco":permco, "permno":permno, "date":date, "gsubind":gsubind, "fic":df.fic,
-              "A":df.A, "E":df.E, "D":df.D, "rf":df.rf, 
-              "DD":DD, "PD":PD, "V":df.V, "sigma_V":sigma_V, "mean_V":mean_V, 
-              "convergence":convergence, "iters":num_iter, 
-              "converge_check":converge_check, "iteration_time":iteration_time, "cusip":cusip}
-    return result
-
-#-------------------------------------
-print("Preparing raw data..." + "\n")
-#-------------------------------------
-
-## read the raw data file
-df = pd.read_csv("/scratch/frbkc/merton_DD_data_WRDS_2020_2025.txt", sep="|")
-df['date'] = pd.to_datetime(df.date)
-
-## check duplicates
-print("\n" + "Are any duplicated?")
-print(df.duplicated(['gvkey', 'fyr', 'permco', 'permno', 'date']).any())
-
-## drop observations missing market cap
-df = df.dropna(subset=['mkt_cap'])
-
-## sort by primary keys
-df = df.sort_values(['gvkey', 'fyr', 'permco', 'permno', 'date'])
-
-## rename columns
-df = df.rename(columns={"assets":"A", "mkt_cap":"E", "face_value_debt":"D", "tyd01y":"rf"})
-
-# Keep obs that are non-zero
-df = df[(df[['E','D','rf']]!=0).all(1)]
-
 #-----------------------------------------------
 print("Reading business daily dates..." + "\n")
 #-----------------------------------------------
-query = """ SELECT date
-            FROM crspq.dsi62
-        """
-market_dates = pd.read_sql(query, dbconn)
-market_dates['date'] = pd.to_datetime(market_dates['date'])
-market_dates = market_dates.sort_values('date')
+## trading calendar from the query cache shared with the data builders,
+## WRDS is only contacted if the cached copy is missing or stale
+market_dates = cached_frame(wrds_connect, DSI_QUERY)
 
-## create 250 day lag
-market_dates['date_lag_250'] = market_dates.date.shift(250)
+#-------------------------------------
+print("Preparing raw data..." + "\n")
+#-------------------------------------
 
-## merge into main data
-df = df.merge(market_dates, on="date", how="left")
+## read the merged panel (typed parquet dataset, see merton_panel.py):
+## only the engine columns, rows with missing or zero E, zero D or zero rf
+## dropped, sorted by primary keys, renamed to A, E, D, rf, with the
+## 250 trading day lag from the calendar; footprint is printed
+panel_path = "/scratch/frbkc/merton_DD_data_WRDS_2020_2025"
+df = load_panel(panel_path, market_dates, budget_mb=memory_mb)
 
 #----------------------------------------------------------
 # Chunk the data by gvkey, fyr, permco, permno combination
+# workers read row offsets into a shared memory panel
 #----------------------------------------------------------
 
-df_by_groups = df.groupby(['gvkey', 'fyr', 'permco', 'permno'])
-df_by_groups = [i[1] for i in df_by_groups]
+bounds = group_bounds(df)
+print("Number of groups:", len(bounds))
 '''test_df = df[(df.gvkey == 5073) & (df.date.dt.year == 1988) & (df.date.dt.month == 4)]
 
 test_date = test_df['date'].max()
@@ -250,76 +85,75 @@ print("""Estimate DD for all gvkeys\n
 Use the simultaneous method """ + "\n")
 #-------------------------------------------
 
-## function to process the results by group
-def sim_by_group(sample):
-
-    ## DataFrame to append results
-    results_df = pd.DataFrame()
-
-    ## get month end dates
-    dates = sample.date.groupby([sample.date.dt.year,sample.date.dt.month]).last()
-
-    ## run simultaneous process for month end dates
-    for idx,daily_dt in dates.items():
-        dt_lag = sample.date_lag_250.loc[sample.date == daily_dt].iloc[0]
-        daily_sample = sample.loc[(dt_lag < sample.date) & (sample.date <= daily_dt)]
-        if daily_sample.shape[0] >= 50 and not (daily_sample[['E', 'D', 'rf']].iloc[-1].isna().any()):
-            x = sim_process(daily_sample, T=1)
-            x = pd.DataFrame([x], columns=x.keys())
-            results_df = pd.concat([results_df, x], ignore_index=True)
-
-    return results_df
+## shards of finished groups, only reused for the same input, code and solvers
+sim_store = open_store("../../../merton_DD_store/sim_2020_2025", mode,
+                       run_fingerprint(panel_path, len(df), [merton_model.__file__], cascade=SIM_CASCADE))
+df_todo = pending_panel(df, sim_store, mode)
+print("Rows left to estimate:", len(df_todo))
 
-## parallel run over samples
+## collect month end inputs in parallel over groups and
+## solve every firm-month of a chunk at once
 num_cpus = mp.cpu_count()
-pool = mp.Pool(processes=num_cpus)
-output = [pool.apply_async(sim_by_group, args=(sample,)) for sample in df_by_groups]
+sim_stats = []
+run_panel(df_todo, sim_inputs_by_group, processes=num_cpus, stats=sim_stats, finish=sim_batch,
+          on_chunk=lambda groups, out: write_shard(sim_store, groups, out))
+results_sim = read_store(sim_store)
 print("Simultaneous processing done.")
+print("Firm-months not converged:", (~results_sim.convergence).sum())
+print("Solver used:\n", results_sim.solver.value_counts(dropna=False))
 
-## get results and write output
-results_sim = pd.concat([p.get()for p in output])
-results_sim.to_csv("../../../test_sim_output_cusip.txt", sep="|", index=False)
+## write output
+write_dataset(results_sim, "../../../test_sim_output_cusip")
 
 #--------------------------------------
 print("""Estimate DD for all gvkeys\n 
 Use the iterated method """ + "\n")
 #--------------------------------------
 
-## function to process the results by group
-def iter_by_group(sample):
-    results = []
-    sample['year'] = sample['date'].dt.year
-    sample['month'] = sample['date'].dt.month
-    month_ends = (sample.groupby(['year', 'month'])['date'].max().reset_index(name='month_end'))
-    date_to_lag = dict(zip(sample['date'], sample['date_lag_250']))
-    month_ends['lag'] = month_ends['month_end'].map(date_to_lag)
-    
-    sample = sample.sort_values('date')
-    for row in month_ends.itertuples(index=False):
-        daily_dt = row.month_end
-        dt_lag = row.lag
-        daily_sample = sample.loc[(sample['date'] > dt_lag) & (sample['date'] <= daily_dt)]
-        if daily_sample.shape[0] >= 50 and not daily_sample[['E', 'D', 'rf']].iloc[-1].isna().any():
-            x = two_step_process(daily_sample, T=1)
-            results.append(x)
-    return pd.DataFrame(results) if results else pd.DataFrame()
+## shards of finished groups, only reused for the same input, code and settings
+iter_store = open_store("../../../merton_DD_store/iter_2020_2025", mode,
+                        run_fingerprint(panel_path, len(df), [merton_model.__file__], accel=accel, tol=ITER_TOL,
+                                        max_iter=ITER_MAX, cascade=V_CASCADE, warm_start=warm_start))
+df_todo = pending_panel(df, iter_store, mode)
+print("Rows left to estimate:", len(df_todo))
 
-## parallel run over samples
+## parallel run over groups, each month end seeded from the previous one
+## unless run cold
 num_cpus = mp.cpu_count()
-pool = mp.Pool(processes=num_cpus)
 #t1 = time.time()
-output = [pool.apply_async(iter_by_group, args=(sample,)) for sample in df_by_groups]
-#output = [iter_by_group(sample) for sample in df_by_groups]
+iter_stats = []
+run_panel(df_todo, iter_by_group, processes=num_cpus, stats=iter_stats, warm_start=warm_start, accel=accel,
+          on_chunk=lambda groups, out: write_shard(iter_store, groups, out))
+results_iter = read_store(iter_store)
 #t2 = time.time()
 #print("Total Time:", t2 - t1)
 print("Two step processing done.")
 
-## get results and write output
-#results_iter = pd.concat([p for p in output])
-results_iter = pd.concat([p.get() for p in output])
+## write output
 print(results_iter['DD'])
 print(results_iter.head())
-results_iter.to_csv("../../../test_iter_cusip_2020_2025.txt", sep="|", index=False)
+write_dataset(results_iter, "../../../test_iter_cusip_2020_2025")
+
+#--------------------------------------------
+print("Solver telemetry..." + "\n")
+#--------------------------------------------
+
+## month ends never handed to a solver, over the whole panel like the
+## results read back from the stores
+skipped = run_panel(df, skipped_by_group, processes=num_cpus)
+
+telemetry = pd.concat([telemetry_table(results_sim, "sim", skipped),
+                       telemetry_table(results_iter, "iter", skipped)], ignore_index=True)
+workers = pd.concat([worker_throughput(sim_stats).assign(stage="sim"),
+                     worker_throughput(iter_stats).assign(stage="iter")], ignore_index=True)
+write_telemetry(telemetry, "../../../merton_DD_telemetry_2020_2025.parquet", workers)
+
+summary = telemetry_summary(telemetry)
+for k, v in summary.items():
+    print("\n" + k + ":")
+    print(v)
+print("\nworker throughput:")
+print(workers)
 
 #------------------------------------------------------
 print("Log closed on " + str(datetime.datetime.now()))
@@ -0,0 +1,201 @@
+#------------------------------------------
+# Synthetic panel benchmark for the
+# simultaneous and iterated DD engines
+#
+# usage: python3 merton_benchmark.py [results.jsonl]
+# one JSON line per case is appended so runs
+# from different versions can be compared
+#
+# python3 merton_benchmark.py checks
+# warm start and sigma_V update checks only
+#------------------------------------------
+
+import sys, os, json, time, datetime, platform, resource, subprocess
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from scipy.stats import norm
+
+from merton_model import sim_by_group, iter_by_group, sim_inputs_by_group, sim_batch, check_warm_start, compare_acceleration
+from merton_scheduler import run_panel
+
+GROUP_KEYS = ['gvkey', 'fyr', 'permco', 'permno']
+
+## panel sizes (firms, trading days) and core counts to run
+SIZES = [(50, 500), (200, 750), (1000, 750)]
+CORES = [1, 4, 8]
+
+## per group runs only go up to this many firms
+MAX_PER_GROUP_FIRMS = 50
+
+#---------------------------
+# Synthetic panel
+#---------------------------
+
+## firms with known asset paths: V follows a geometric Brownian motion with
+## drift mu and volatility sigma_V, debt D is fixed within each quarter and
+## equity is the Merton call price, so the true DD is known at every date
+def synthetic_panel(n_firms, n_days, seed=0, T=1.0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2015-01-01", periods=n_days + 250)
+    calendar = pd.DataFrame({"date":dates, "date_lag_250":pd.Series(dates).shift(250)})
+    rf = 0.01 + 0.02*np.abs(np.sin(np.arange(len(dates))/500))
+    quarter = pd.factorize(dates.to_period('Q'))[0]
+
+    panel = []; truth = []
+    for f in range(n_firms):
+        ## firms enter at different dates
+        start = rng.integers(0, 250)
+        n = len(dates) - start
+        sigma_V = rng.uniform(0.1, 0.6)
+        mu = rng.uniform(-0.02, 0.12)
+        V = rng.uniform(100, 5000)*np.exp(np.cumsum((mu - 0.5*sigma_V**2)/252 + sigma_V/np.sqrt(252)*rng.standard_normal(n)))
+        lev = rng.uniform(0.1, 0.8)
+        D = lev*V[0]*np.exp(0.02*(quarter[start:] - quarter[start]))
+        r = rf[start:]
+
+        d1 = (np.log(V/D) + (r + 0.5*sigma_V**2)*T)/(sigma_V*np.sqrt(T))
+        d2 = d1 - sigma_V*np.sqrt(T)
+        E = V*norm.cdf(d1) - np.exp(-r*T)*D*norm.cdf(d2)
+
+        keys = {"gvkey":1000 + f, "fyr":12, "permco":20000 + f, "permno":10000 + f}
+        panel.append(pd.DataFrame(dict(keys, date=dates[start:], gsubind=45102010.0 + 10*(f % 7),
+                                       fic="USA", cusip="%06d10" % (100000 + f),
+                                       A=V, E=E, D=D, rf=r)))
+        truth.append(pd.DataFrame(dict(keys, date=dates[start:], V_true=V, sigma_V_true=sigma_V,
+                                       mu_true=mu, D_true=D, rf_true=r)))
+
+    panel = pd.concat(panel, ignore_index=True).merge(calendar, on="date", how="left")
+    panel = panel.sort_values(GROUP_KEYS + ['date']).reset_index(drop=True)
+    truth = pd.concat(truth, ignore_index=True)
+
+    ## true DD with each engine's own formula
+    truth['DD_sim_true'] = (np.log(truth.V_true/truth.D_true) + (truth.rf_true - 0.5*truth.sigma_V_true)*T)/(truth.sigma_V_true*np.sqrt(T))
+    truth['DD_iter_true'] = (np.log(truth.V_true/truth.D_true) + (truth.mu_true - 0.5*truth.sigma_V_true**2))/truth.sigma_V_true
+    return panel, truth
+
+#---------------------------
+# Engines
+#---------------------------
+
+## one apply_async per firm group, as merton_DD.py used to run
+def _per_group(engine, **kwargs):
+    def run(panel, processes):
+        groups = [g for _, g in panel.groupby(GROUP_KEYS)]
+        with mp.Pool(processes=processes) as pool:
+            out = [pool.apply_async(engine, (g,), kwargs) for g in groups]
+            out = [p.get() for p in out]
+        return pd.concat(out, ignore_index=True)
+    return run
+
+## shared memory scheduler
+def _scheduled(engine, finish=None, **kwargs):
+    def run(panel, processes):
+        return run_panel(panel, engine, processes=processes, finish=finish, **kwargs)
+    return run
+
+## name -> (method, runner, per group)
+ENGINES = {"sim_by_group":("sim", _per_group(sim_by_group), True),
+           "sim_batch":("sim", _scheduled(sim_inputs_by_group, finish=sim_batch), False),
+           "iter_by_group":("iter", _per_group(iter_by_group), True),
+           "iter_scheduled":("iter", _scheduled(iter_by_group), False),
+           "iter_warm":("iter", _scheduled(iter_by_group, warm_start=True), False),
+           "iter_aitken":("iter", _scheduled(iter_by_group, accel="aitken"), False),
+           "iter_anderson":("iter", _scheduled(iter_by_group, accel="anderson"), False)}
+
+#---------------------------
+# Benchmark cases
+#---------------------------
+
+def _peak_rss_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children)/1024
+
+## time one engine on one panel in a fresh process so peak RSS is its own
+def _case(name, panel, truth, processes, queue):
+    method, run, per_group = ENGINES[name]
+    t0 = time.time()
+    out = run(panel, processes)
+    seconds = time.time() - t0
+
+    out = out.assign(date=pd.to_datetime(out.date)).merge(truth, on=GROUP_KEYS + ['date'], how='left')
+    err = out.DD - out['DD_' + method + '_true']
+    queue.put({"firm_months":len(out), "seconds":seconds,
+               "firm_months_per_sec":len(out)/seconds if seconds > 0 else np.nan,
+               "peak_rss_mb":_peak_rss_mb(),
+               "converged":float(out.convergence.mean()) if len(out) else np.nan,
+               "dd_mae":float(np.nanmean(np.abs(err))) if len(out) else np.nan,
+               "dd_rmse":float(np.sqrt(np.nanmean(err**2))) if len(out) else np.nan,
+               "sigma_V_mae":float(np.nanmean(np.abs(out.sigma_V - out.sigma_V_true))) if len(out) else np.nan})
+
+def _version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except Exception:
+        return None
+
+## run every engine at every size and core count, appending JSON lines to path
+def run_benchmark(path, sizes=SIZES, cores=CORES, engines=None, seed=0):
+    engines = engines or list(ENGINES)
+    info = {"version":_version(), "run_at":datetime.datetime.now().isoformat(timespec='seconds'),
+            "host":platform.node(), "python":platform.python_version(),
+            "numpy":np.__version__, "pandas":pd.__version__}
+
+    results = []
+    for n_firms, n_days in sizes:
+        panel, truth = synthetic_panel(n_firms, n_days, seed=seed)
+        for name in engines:
+            if ENGINES[name][2] and n_firms > MAX_PER_GROUP_FIRMS:
+                continue
+            for processes in cores:
+                queue = mp.Queue()
+                p = mp.Process(target=_case, args=(name, panel, truth, processes, queue))
+                p.start(); x = queue.get(); p.join()
+                x = dict(info, engine=name, n_firms=n_firms, n_days=n_days, processes=processes, **x)
+                print(json.dumps(x))
+                results.append(x)
+                with open(path, "a") as f:
+                    f.write(json.dumps(x) + "\n")
+    return pd.DataFrame(results)
+
+## latest run against the previous version for each case
+## ratio < 1 means the latest version is slower
+def compare_versions(path):
+    runs = pd.read_json(path, lines=True)
+    case = ['engine', 'n_firms', 'n_days', 'processes']
+    versions = runs.drop_duplicates('version', keep='last').sort_values('run_at').version.tolist()
+    if len(versions) < 2:
+        return pd.DataFrame()
+    prev = runs.loc[runs.version == versions[-2]].drop_duplicates(case, keep='last')
+    last = runs.loc[runs.version == versions[-1]].drop_duplicates(case, keep='last')
+    out = last.merge(prev, on=case, suffixes=('', '_prev'))
+    out['speed_ratio'] = out.firm_months_per_sec/out.firm_months_per_sec_prev
+    out['rss_ratio'] = out.peak_rss_mb/out.peak_rss_mb_prev
+    out['dd_mae_change'] = out.dd_mae - out.dd_mae_prev
+    return out[case + ['firm_months_per_sec', 'speed_ratio', 'rss_ratio', 'dd_mae_change']]
+
+#---------------------------
+# Solver checks
+#---------------------------
+
+## warm against cold start and the plain and accelerated sigma_V updates on
+## the first n_groups firm groups of a panel, kept out of merton_DD.py so
+## production runs do not pay for them
+def solver_checks(panel, n_groups=20):
+    groups = [g for _, g in panel.groupby(GROUP_KEYS, sort=False)][:n_groups]
+    warm = pd.DataFrame([dict(check_warm_start(g), **g[GROUP_KEYS].iloc[0].to_dict()) for g in groups])
+    return warm, compare_acceleration(groups)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "checks":
+        warm, accel = solver_checks(synthetic_panel(MAX_PER_GROUP_FIRMS, 750)[0])
+        print("Warm start check:")
+        print(warm)
+        print("sigma_V update comparison:")
+        print(accel)
+        sys.exit()
+    path = sys.argv[1] if len(sys.argv) > 1 else "merton_benchmark.jsonl"
+    run_benchmark(path)
+    print(compare_versions(path))
@@ -0,0 +1,11 @@
+#!/bin/bash
+#$ -cwd
+
+#$ -N merton_benchmark
+#$ -pe onenode 8
+#$ -l m_mem_free=6G
+source ~/virtualenv/base_python/bin/activate
+
+## results are appended so versions can be compared
+python3 merton_benchmark.py ./logfiles/merton_benchmark.jsonl
+deactivate
@@ -0,0 +1,135 @@
+#------------------------------------------
+# Checkpoint shards for merton_DD.py
+# finished firm groups are written as
+# they complete so a run can resume, and
+# incremental runs append new month ends
+#------------------------------------------
+
+import os, glob, time, json, hashlib
+import pandas as pd
+
+GROUP_KEYS = ['gvkey', 'fyr', 'permco', 'permno']
+
+## run modes
+##   full        clear the store and estimate everything
+##   resume      skip firm groups finished by an earlier run of the same fingerprint
+##   incremental estimate only month ends after the last stored one per group
+MODES = ["full", "resume", "incremental"]
+
+## fingerprint keys of the input data, allowed to change between incremental
+## runs (new month ends), everything else has to match to reuse a store
+INPUT_KEYS = ['input_mtime', 'input_rows']
+
+## what a store's results depend on: the input panel (path, last modified
+## time of its files, rows), the code of the given modules and the settings
+## (e.g. accel, tol, cascade)
+def run_fingerprint(input_path, rows, code_files=(), **settings):
+    files = glob.glob(os.path.join(input_path, "**", "*.parquet"), recursive=True) or [input_path]
+    mtime = max([os.path.getmtime(f) for f in files if os.path.exists(f)], default=None)
+    code = hashlib.sha256()
+    for f in code_files:
+        with open(f, "rb") as fh:
+            code.update(fh.read())
+    fp = dict(settings, input_path=os.path.abspath(input_path), input_mtime=mtime, input_rows=int(rows),
+              code=code.hexdigest())
+    return json.loads(json.dumps(fp, default=str))
+
+def read_fingerprint(path):
+    f = os.path.join(path, "fingerprint.json")
+    if not os.path.exists(f):
+        return None
+    with open(f) as fh:
+        return json.load(fh)
+
+def write_fingerprint(path, fp):
+    f = os.path.join(path, "fingerprint.json")
+    with open(f + ".tmp", "w") as fh:
+        json.dump(fp, fh, indent=1)
+    os.replace(f + ".tmp", f)
+
+## create the shard directory, emptied for a full run
+## resume and incremental runs refuse a store written with a different
+## fingerprint (input, code or settings; incremental runs may see new input)
+def open_store(path, mode="full", fingerprint=None):
+    if mode not in MODES:
+        raise ValueError("mode must be one of " + ", ".join(MODES))
+    os.makedirs(path, exist_ok=True)
+    if mode == "full":
+        for f in glob.glob(os.path.join(path, "part-*")):
+            os.remove(f)
+    elif fingerprint is not None and _done_files(path):
+        stored = read_fingerprint(path) or {}
+        skip = INPUT_KEYS if mode == "incremental" else []
+        changed = sorted(k for k in set(stored) | set(fingerprint)
+                         if k not in skip and stored.get(k) != fingerprint.get(k))
+        if changed:
+            raise ValueError("store " + path + " was written by a different run (" + ", ".join(changed) +
+                             " changed), rerun with mode full")
+    if fingerprint is not None:
+        write_fingerprint(path, fingerprint)
+    return path
+
+## write to a temporary name then rename, so a shard is either complete or absent
+def _atomic_parquet(df, path):
+    tmp = path + ".tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+## persist one finished chunk: results first, then the list of groups it covers
+## a chunk only counts as done once its .done file exists
+def write_shard(path, groups, out):
+    name = os.path.join(path, "part-%d-%d" % (time.time_ns(), os.getpid()))
+    if out is not None and len(out) > 0:
+        out = out.copy()
+        out['date'] = pd.to_datetime(out['date'])
+        _atomic_parquet(out, name + ".parquet")
+    _atomic_parquet(groups[GROUP_KEYS], name + ".done.parquet")
+
+def _done_files(path):
+    return sorted(glob.glob(os.path.join(path, "part-*.done.parquet")))
+
+## keys of every firm group with a finished shard
+def completed_groups(path):
+    files = _done_files(path)
+    if not files:
+        return pd.DataFrame(columns=GROUP_KEYS)
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True).drop_duplicates()
+
+## all results from finished shards in key and date order
+## shards without a .done file (a crash between the two writes) are ignored
+## a month stored from a partial month of data is superseded by a later month end
+def read_store(path, columns=None):
+    files = [f.replace(".done.parquet", ".parquet") for f in _done_files(path)]
+    files = [f for f in files if os.path.exists(f)]
+    if not files:
+        return pd.DataFrame()
+    out = pd.concat([pd.read_parquet(f, columns=columns) for f in files], ignore_index=True)
+    out = out.sort_values(GROUP_KEYS + ['date'], kind='stable')
+    month = out.date.dt.to_period('M')
+    out = out.loc[~pd.concat([out[GROUP_KEYS], month], axis=1).duplicated(keep='last')]
+    return out.reset_index(drop=True)
+
+## last stored month end per firm group
+def stored_through(path):
+    out = read_store(path, columns=GROUP_KEYS + ['date'])
+    if out.empty:
+        return pd.DataFrame(columns=GROUP_KEYS + ['done_through'])
+    return out.groupby(GROUP_KEYS, as_index=False).date.max().rename(columns={"date":"done_through"})
+
+## restrict the sorted panel to the work left for this mode
+## resume drops finished groups, incremental adds a done_through column
+## that window_index uses to skip stored month ends
+def pending_panel(df, path, mode):
+    if mode == "resume":
+        done = completed_groups(path)
+        if done.empty:
+            return df
+        keys = pd.MultiIndex.from_frame(df[GROUP_KEYS])
+        return df.loc[~keys.isin(pd.MultiIndex.from_frame(done.astype(df[GROUP_KEYS].dtypes.to_dict())))]
+    if mode == "incremental":
+        through = stored_through(path)
+        if through.empty:
+            return df
+        through = through.astype(df[GROUP_KEYS].dtypes.to_dict())
+        return df.merge(through, on=GROUP_KEYS, how="left")
+    return df
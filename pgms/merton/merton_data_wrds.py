@@ -16,9 +16,11 @@ print("Log created on " + str(datetime.datetime.now()) + '\n')
 import os 
 import wrds
 import psycopg2
-import numpy as np
 import pandas as pd
 #import pandasql as ps
+from wrds_extract import plan
+from merton_store import refresh_store
+from merton_join import MERGED_COLS, stack_parquet
 
 #modules = dir()
 #print(modules)
@@ -26,69 +28,40 @@ import pandas as pd
 #wary of ./data or /data
 os.chdir("./data/compustat/policy/")
 
+## refresh mode: incremental (default, only rows past the stored
+## high-water marks) or full, see merton_store.py
+mode = sys.argv[1] if len(sys.argv) > 1 else "incremental"
+print("Refresh mode:", mode)
+
 #-------------------------------
-# Establish database connection
+# Establish database connections
 #-------------------------------
 #dbconn = psycopg2.connect(host = 'wrds-pgdata.wharton.upenn.edu', dbname = 'wrds', port='9737')
-db = wrds.Connection()
-#----------------------
-# Daily stock prices
-# From CRSP data 
-# with GVKEY from CCM
-#----------------------
-#a.cusip
-query = """ SELECT a.*, b.htick, b.hcomnam, b.hshrcd, b.hnaics, c.gvkey,
-                   abs(a.prc)*a.shrout/1E3 as mkt_cap
-            FROM crspq.dsf62 as a
-             LEFT JOIN crspq.dsfhdr62 as b
-                   ON  a.permco = b.permco
-                   AND a.permno = b.permno
-                   AND a.date between b.begdat and b.enddat
-             LEFT JOIN (SELECT gvkey, lpermno, linkdt, linkenddt
-                        FROM crspq.ccmxpf_linktable
-                        WHERE linktype IN ('LU', 'LC')
-                          AND linkprim in ('P', 'C')) as c
-                    ON  a.permno = c.lpermno
-                    AND a.date between c.linkdt AND coalesce(c.linkenddt, CAST('9999-12-31' AS DATE))
-             WHERE a.date between CAST('2020-01-01' AS DATE) AND CAST('2025-12-31' AS DATE)
-               AND b.hshrcd IN (10,11)
-               AND a.prc IS NOT NULL """
-
-#crsp = pd.read_sql(query, dbconn)
-crsp = db.raw_sql(query)
-crsp['date'] = pd.to_datetime(crsp['date'])
-
-#---------------------
-# Compustat
-# company information
-#---------------------
-query = """ SELECT * 
-            FROM comp.company """
-#company = pd.read_sql(query, dbconn)
-company = db.raw_sql(query)
-
-
-#---------------------
-# Compustat quarterly 
-# balance sheet info
-#---------------------
-query = """ SELECT datadate, gvkey, fyr, lctq as current_liabilities, ltq as total_liabilities,
-                   CASE 
-                      WHEN lctq IS NOT NULL AND ltq IS NOT NULL THEN ltq - lctq
-                      WHEN lctq IS NULL AND ltq IS NOT NULL THEN ltq
-                   END AS lt_liabilities, 
-                   CASE
-                      WHEN lctq IS NOT NULL AND ltq IS NOT NULL THEN lctq + 0.5*ltq
-                      WHEN lctq IS NULL AND ltq IS NOT NULL THEN 0.5*ltq
-                      WHEN lctq IS NOT NULL AND ltq IS NULL THEN lctq
-                   END AS face_value_debt, atq as assets
-            FROM comp.co_ifndq
-            WHERE indfmt = 'INDL' AND datafmt = 'STD' AND consol = 'C' AND popsrc = 'D' """
-
-#co_ifndq = pd.read_sql(query, dbconn)
-co_ifndq = db.raw_sql(query)
-co_ifndq['datadate'] = pd.to_datetime(co_ifndq['datadate'])
-
+#db = wrds.Connection()
+## small pool, independent queries run concurrently, opened only for
+## queries missing from the local cache (wrds_cache.py)
+connect = wrds.Connection
+
+## sample period, and the columns fetched from each source
+## pushed down from the merged columns the DD stage reads
+START = "2020-01-01"
+END = "2025-12-31"
+needs = plan(MERGED_COLS)
+
+#----------------------------------------------
+# Daily stock prices from CRSP with GVKEY from
+# CCM (fetched in yearly date partitions),
+# Compustat company information and quarterly
+# balance sheet info, business daily dates
+#----------------------------------------------
+raw = refresh_store(connect, "./merton_raw_store", needs, START, END, mode=mode, months=12, size=4)
+
+company = raw["company"]
+
+## reporting windows and carried forward quarters, from the store
+co_ifndq = raw["co_ifndq"]
+market_dates = raw["market_dates"]
+market_dates['date'] = pd.to_datetime(market_dates['date'])
 
 #----------------------------------------------------------
 # Risk free rates (1-year constant maturity Treasury rate)
@@ -99,72 +72,19 @@ H15 = H15.rename(columns={"TIME_PERIOD":"date", "RIFLGFCY01_N.B":"tyd01y"})
 H15['tyd01y'] = H15['tyd01y']/100
 H15['date'] = pd.to_datetime(H15['date'])
 
-#------------------------
-# business daily dates
-#-----------------------
-query = """ SELECT date
-            FROM crspq.dsi62
-        """
-#market_dates = pd.read_sql(query, dbconn)
-market_dates = db.raw_sql(query)
-market_dates['date'] = pd.to_datetime(market_dates['date'])
-
 #----------------------------------------
 # match stock prices to risk-free rates
+# and add company names and sectors
 #----------------------------------------
-crsp = crsp.merge(H15, how='left', on = 'date')
-
-#-------------------------------
-# Add company names and sectors
-#-------------------------------
-crsp = crsp.merge(company[['gvkey', 'conm', 'gsubind', 'fic']], on='gvkey', how='left')
-
-#------------------------------------------
-# Set reporting period start and end dates
-#------------------------------------------
-## sort data
-co_ifndq = co_ifndq.sort_values(['gvkey', 'fyr', 'datadate'])
-
-## get start of reporting period (start of quarter)
-co_ifndq['dt_end'] = co_ifndq['datadate']
-co_ifndq['dt_start'] = pd.to_datetime(co_ifndq['dt_end'].values.astype('datetime64[M]')) - pd.DateOffset(months=2)
-
-#------------------------------------------------------------
-# Repeat the last quarter financial data if not reported yet
-#------------------------------------------------------------
-
-current_qtr = crsp.date.max().to_pydatetime() + pd.tseries.offsets.QuarterEnd()
-back_1qtr = current_qtr.to_pydatetime() - pd.tseries.offsets.QuarterEnd(1)
-back_2qtr = current_qtr.to_pydatetime() - pd.tseries.offsets.QuarterEnd(2)
-back_3qtr = current_qtr.to_pydatetime() - pd.tseries.offsets.QuarterEnd(3)
-
-## all data from 2 quarters ago
-co_ifndq_2qtr = co_ifndq.loc[(back_3qtr < co_ifndq.dt_start) & (co_ifndq.dt_end <= back_2qtr)].copy()
-
-## all gvkeys from 2 quarters ago
-gvkeys_2qtr = co_ifndq_2qtr.gvkey.unique().tolist()
-
-## repeat data not reported 1 quarter ago
-gvkeys_1qtr = co_ifndq.gvkey.loc[(back_2qtr < co_ifndq.dt_start) & (back_1qtr <= co_ifndq.dt_end)].unique().tolist()
-gvkeys_missing = np.setdiff1d(gvkeys_2qtr, gvkeys_1qtr)
-co_ifndq_1qtr = co_ifndq_2qtr.loc[co_ifndq_2qtr.gvkey.isin(gvkeys_missing)].copy()
-co_ifndq_1qtr['dt_start'] = back_2qtr + pd.DateOffset(1)
-co_ifndq_1qtr['dt_end'] = back_1qtr
-
-## repeat data for current quarter
-gvkeys_current_qtr = co_ifndq.gvkey.loc[(back_1qtr < co_ifndq.dt_start) & (current_qtr <= co_ifndq.dt_end)].unique().tolist()
-gvkeys_missing = np.setdiff1d(gvkeys_2qtr, gvkeys_current_qtr)
-co_ifndq_current_qtr = co_ifndq_2qtr.loc[co_ifndq_2qtr.gvkey.isin(gvkeys_missing)].copy()
-co_ifndq_current_qtr['dt_start'] = back_1qtr + pd.DateOffset(1)
-co_ifndq_current_qtr['dt_end'] = current_qtr
+def rates_and_names(crsp):
+    crsp['date'] = pd.to_datetime(crsp['date'])
+    crsp = crsp.merge(H15, how='left', on = 'date')
+    return crsp.merge(company[['gvkey', 'conm', 'gsubind', 'fic']], on='gvkey', how='left')
 
-## append data
-#co_ifndq = co_ifndq.append(co_ifndq_1qtr)
-#co_ifndq = co_ifndq.append(co_ifndq_current_qtr)
-pdlist = [co_ifndq, co_ifndq_1qtr, co_ifndq_current_qtr]
-co_ifndq = pd.concat(pdlist)
 co_ifndq.to_parquet("./co_ifndq.parquet")
-crsp.to_parquet("./crsp.parquet")
+## one CRSP year of the store in memory at a time
+n = stack_parquet(raw["crsp_files"], "./crsp.parquet", prepare=rates_and_names)
+print("CRSP rows written", n)
 
 #------------------------------------------------------
 print("Log closed on " + str(datetime.datetime.now()))
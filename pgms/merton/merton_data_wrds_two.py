@@ -12,45 +12,37 @@ import wrds
 import psycopg2
 import numpy as np
 import pandas as pd
-import pandasql as ps
-import gc
+from merton_join import interval_join, stream_join, write_partitions, MERGED_COLS
+from merton_panel import write_dataset
 
 #modules = dir()
 #print(modules)                                                                                                                             
 #wary of ./data or /data
 os.chdir("./data/compustat/policy/")
 
+## build mode: memory (whole panel in pandas) or stream (out of core)
+## and the memory budget in MB for a streaming build
+build = sys.argv[1] if len(sys.argv) > 1 else "memory"
+memory_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
 ## now merge between dates
 co_ifndq = pd.read_parquet("./co_ifndq.parquet")
-crsp = pd.read_parquet("./crsp.parquet")
-col_needed = ['date', 'gvkey', 'permco', 'permno', 'cusip', 'datadate', 'conm', 'gsubind',
-            'fyr', 'fic', 'mkt_cap', 'assets', 'face_value_debt', 'tyd01y']
-
-first_chunk = True
+col_needed = MERGED_COLS
 
-n = 50000
-output_file = "/scratch/frbkc/merton_DD_data_WRDS_2020_2025.txt"
-for i in range(0, crsp.shape[0], n):
-    crsp_chunk = crsp.iloc[i:i + n].copy()
-    merged_chunk = crsp_chunk.merge(co_ifndq, on='gvkey', how='inner')
-    crsp_chunk = None
-    gc.collect()
-    merged_chunk = merged_chunk[(merged_chunk['date'] >= merged_chunk['dt_start']) &
-                                (merged_chunk['date'] <= merged_chunk['dt_end'])]
-    merged_chunk = merged_chunk[col_needed]
-    if first_chunk:
-        merged_chunk.to_csv(output_file, sep="|", index=False, mode='w')
-        first_chunk = False
-        print("first chunk", len(merged_chunk))
-    else:
-        merged_chunk.to_csv(output_file, sep="|", index=False, mode='a', header=False)
-        print("append chunk", len(merged_chunk))
-    merged_chunk = None
-    gc.collect()
+## typed parquet dataset partitioned by year_month, see merton_panel.py
+output_path = "/scratch/frbkc/merton_DD_data_WRDS_2020_2025"
 
-crsp_full = None
-co_ifndq = None
-gc.collect()
+if build == "stream":
+    ## CRSP streamed from parquet in partitions sized to the memory budget
+    parts = stream_join("./crsp.parquet", co_ifndq, memory_mb=memory_mb)
+    n = write_partitions(parts, output_path, columns=col_needed)
+    print("merged rows", n)
+else:
+    ## one sorted interval join instead of chunked merge then filter
+    crsp = pd.read_parquet("./crsp.parquet")
+    merged = interval_join(crsp, co_ifndq)[col_needed]
+    write_dataset(merged, output_path)
+    print("merged rows", len(merged))
 
 
 #crsp = pysqldf(""" SELECT a.date, a.gvkey, a.permco, a.permno, b.datadate, a.conm, a.gsubind, b.fyr, a.fic,
@@ -0,0 +1,208 @@
+#------------------------------------------
+# Interval join of daily CRSP rows to
+# Compustat reporting quarters
+#------------------------------------------
+
+import os, shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from merton_panel import write_dataset
+
+## CRSP and Compustat columns kept by the data builders
+CRSP_COLS = ['date', 'gvkey', 'permco', 'permno', 'cusip', 'conm', 'gsubind', 'fic', 'mkt_cap', 'tyd01y']
+CO_COLS = ['datadate', 'fyr', 'assets', 'face_value_debt']
+
+## merged panel columns read by merton_DD.py, extraction fetches only what these need
+MERGED_COLS = ['date', 'gvkey', 'permco', 'permno', 'cusip', 'datadate', 'conm', 'gsubind',
+               'fyr', 'fic', 'mkt_cap', 'assets', 'face_value_debt', 'tyd01y']
+
+## sortable int64 key of (gvkey code, day)
+def _key(code, date):
+    days = pd.to_datetime(date).to_numpy().astype('datetime64[D]').astype(np.int64)
+    return code.astype(np.int64)*(2**32) + (days + 2**31)
+
+## concatenated ranges [lo, hi) without a Python loop
+def _ranges(lo, counts):
+    total = counts.sum()
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(lo, counts) + np.arange(total) - offsets
+
+## inner join crsp to co_ifndq on gvkey with dt_start <= date <= dt_end
+## each quarter interval finds its block of days with searchsorted on the
+## (gvkey, date) sorted CRSP keys, so memory is linear in the output and
+## overlapping intervals (e.g. two fiscal year ends) still match every row
+## rows come back in CRSP order, then Compustat order, as an inner merge would
+def interval_join(crsp, co_ifndq, crsp_cols=None, co_cols=None, sort=True):
+    crsp_cols = crsp_cols or [c for c in CRSP_COLS if c in crsp]
+    co_cols = co_cols or [c for c in CO_COLS if c in co_ifndq]
+
+    ## common integer codes for gvkey, missing gvkeys never match
+    codes, uniques = pd.factorize(pd.concat([crsp.gvkey, co_ifndq.gvkey], ignore_index=True))
+    crsp_code = codes[:len(crsp)]
+    co_code = codes[len(crsp):]
+
+    ## sorted CRSP keys
+    crsp_key = _key(crsp_code, crsp.date)
+    crsp_key[crsp_code < 0] = -1
+    order = np.argsort(crsp_key, kind='stable')
+    crsp_key = crsp_key[order]
+
+    ## block of sorted CRSP rows inside each quarter
+    ok = (co_code >= 0) & co_ifndq.dt_start.notna().values & co_ifndq.dt_end.notna().values
+    co_idx = np.flatnonzero(ok)
+    lo = np.searchsorted(crsp_key, _key(co_code[ok], co_ifndq.dt_start.values[ok]), side='left')
+    hi = np.searchsorted(crsp_key, _key(co_code[ok], co_ifndq.dt_end.values[ok]), side='right')
+    counts = np.maximum(hi - lo, 0)
+
+    crsp_rows = order[_ranges(lo, counts)]
+    co_rows = np.repeat(co_idx, counts)
+    if sort:
+        i = np.lexsort((co_rows, crsp_rows))
+        crsp_rows = crsp_rows[i]; co_rows = co_rows[i]
+
+    out = crsp[crsp_cols].iloc[crsp_rows].reset_index(drop=True)
+    right = co_ifndq[[c for c in co_cols if c not in crsp_cols]].iloc[co_rows].reset_index(drop=True)
+    return pd.concat([out, right], axis=1)
+
+#---------------------------
+# Reporting quarters
+#---------------------------
+
+## reporting period of each quarter: dt_end is datadate, dt_start the first
+## day of the quarter's first month
+def quarter_windows(co_ifndq):
+    co_ifndq = co_ifndq.sort_values(['gvkey', 'fyr', 'datadate'])
+    co_ifndq['dt_end'] = co_ifndq['datadate']
+    co_ifndq['dt_start'] = pd.to_datetime(co_ifndq['dt_end'].values.astype('datetime64[M]')) - pd.DateOffset(months=2)
+    return co_ifndq
+
+## quarters a report is carried forward when the next one is late or missing
+CARRY_QTRS = 2
+
+## as-of fill: every reported quarter (with dt_start/dt_end from quarter_windows)
+## is repeated into the following quarters, up to quarters of them, until the
+## gvkey reports again (under any fyr, so a fiscal year change does not overlap)
+## or the quarter starts after last_date, the last CRSP date
+## filled rows keep the source datadate and get the missing quarter's window
+## works on any subset of gvkeys, so incremental refreshes can redo only some
+def carry_forward(co_ifndq, last_date, quarters=CARRY_QTRS):
+    ## next reported datadate of the same gvkey
+    reports = co_ifndq[['gvkey', 'datadate']].drop_duplicates().sort_values(['gvkey', 'datadate'])
+    reports['next_datadate'] = reports.groupby('gvkey').datadate.shift(-1)
+    nxt = co_ifndq[['gvkey', 'datadate']].merge(reports, on=['gvkey', 'datadate'], how='left').next_datadate
+    next_start = (nxt.values.astype('datetime64[M]') - 2).astype('datetime64[ns]')
+
+    ## candidate quarters k = 1..quarters after each report
+    row = np.repeat(np.arange(len(co_ifndq)), quarters)
+    k = np.tile(np.arange(1, quarters + 1), len(co_ifndq))
+    month = co_ifndq.datadate.values.astype('datetime64[M]')[row] + 3*k
+    dt_end = ((month + 1).astype('datetime64[D]') - 1).astype('datetime64[ns]')
+    dt_start = (month - 2).astype('datetime64[ns]')
+
+    ## keep quarters before the next report's window and not after the sample
+    nxt_start = next_start[row]
+    keep = (np.isnat(nxt_start) | (dt_end < nxt_start)) & (dt_start <= np.datetime64(pd.Timestamp(last_date), 'ns'))
+
+    filled = co_ifndq.iloc[row[keep]].copy()
+    filled['dt_start'] = dt_start[keep]
+    filled['dt_end'] = dt_end[keep]
+    return pd.concat([co_ifndq, filled])
+
+## gvkeys with a candidate carried quarter starting in (old_date, new_date]:
+## carry_forward stops at the last CRSP date, so these can gain a window when
+## it moves from old_date to new_date (fiscal quarters need not match calendar ones)
+def carry_crossed(co_ifndq, old_date, new_date, quarters=CARRY_QTRS):
+    month = co_ifndq.datadate.values.astype('datetime64[M]')
+    dt_start = (month[:, None] + 3*np.arange(1, quarters + 1) - 2).astype('datetime64[ns]')
+    hit = ((dt_start > np.datetime64(pd.Timestamp(old_date), 'ns')) &
+           (dt_start <= np.datetime64(pd.Timestamp(new_date), 'ns'))).any(axis=1)
+    return sorted(co_ifndq.gvkey.values[hit].tolist())
+
+#---------------------------
+# Out of core build
+#---------------------------
+
+## default memory budget in MB for a streaming build
+MEMORY_MB = 4096
+
+## working copies per merged row (sort keys, index arrays, concat) on top of the row itself
+OVERHEAD = 4
+
+## in memory bytes per CRSP row, measured on the first rows of the file
+def _row_bytes(pf, columns, n=10000):
+    x = next(pf.iter_batches(batch_size=n, columns=columns)).to_pandas()
+    return x.memory_usage(index=False, deep=True).sum()/max(len(x), 1)
+
+## CRSP rows per partition so that the partition, its merged output and the
+## working copies fit in what the budget leaves after co_ifndq
+def partition_rows(pf, co_ifndq, memory_mb=MEMORY_MB, columns=None):
+    co_bytes = co_ifndq.memory_usage(index=True, deep=True).sum()
+    free = memory_mb*2**20 - 2*co_bytes
+    if free <= 0:
+        raise MemoryError("co_ifndq alone needs %.0f MB, over the %d MB budget" % (2*co_bytes/2**20, memory_mb))
+    crsp_bytes = _row_bytes(pf, columns)
+    row = crsp_bytes + co_bytes/max(len(co_ifndq), 1)
+    return max(int(free/(OVERHEAD*(crsp_bytes + row))), 1000)
+
+## interval join of a CRSP parquet file streamed in partitions of row groups
+## co_ifndq stays in memory (one row per firm quarter), CRSP never does
+## yields each merged partition, empty ones are skipped
+def stream_join(crsp_path, co_ifndq, memory_mb=MEMORY_MB, crsp_cols=None, co_cols=None):
+    pf = pq.ParquetFile(crsp_path)
+    names = pf.schema_arrow.names
+    crsp_cols = crsp_cols or [c for c in CRSP_COLS if c in names]
+    co_cols = co_cols or [c for c in CO_COLS if c in co_ifndq]
+    rows = partition_rows(pf, co_ifndq, memory_mb, crsp_cols)
+
+    ## only the columns the join needs
+    co_ifndq = co_ifndq[['gvkey', 'dt_start', 'dt_end'] + [c for c in co_cols if c != 'gvkey']]
+    for batch in pf.iter_batches(batch_size=rows, columns=crsp_cols):
+        crsp = batch.to_pandas()
+        crsp['date'] = pd.to_datetime(crsp['date'])
+        merged = interval_join(crsp, co_ifndq, crsp_cols=crsp_cols, co_cols=co_cols)
+        if len(merged) > 0:
+            yield merged
+
+## parquet files (e.g. CRSP years or partitions) stacked into one parquet file
+## at out, one file in memory at a time, each passed through prepare first
+## (e.g. the risk free rate and company merges); types follow the first file
+## returns the number of rows written
+def stack_parquet(paths, out, prepare=None):
+    writer = None; n = 0
+    try:
+        for p in paths:
+            x = pd.read_parquet(p)
+            if prepare is not None:
+                x = prepare(x)
+            if len(x) == 0:
+                continue
+            table = pa.Table.from_pandas(x, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out + ".tmp", table.schema)
+            writer.write_table(table.cast(writer.schema))
+            n += len(x)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError("no rows to write to " + out)
+    os.replace(out + ".tmp", out)
+    return n
+
+## write partitions into a year_month partitioned dataset under path
+## (merton_panel.write_dataset), part i going to part-i-*.parquet files
+## returns the number of merged rows written
+def write_partitions(parts, path, columns=None):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+    n = 0
+    for i, x in enumerate(parts):
+        if columns is not None:
+            x = x[columns]
+        write_dataset(x, path, mode="append", part=i)
+        n += len(x)
+        print("partition", i, len(x))
+    return n
@@ -0,0 +1,666 @@
+#----------------------------------------
+# Merton distance-to-default estimation
+# routines shared by merton_DD.py
+#----------------------------------------
+
+import time, warnings
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from scipy.optimize import fsolve
+from scipy.optimize import brentq
+from scipy.optimize import root
+
+from scipy.optimize import least_squares
+
+#------------------------
+# Simultaneous procedure
+#------------------------
+
+# Simultaneous Merton Model function
+def merton_sim(x, E, D, sigma_E, r, T):
+
+    V = x[0]
+    sigma_V = x[1]
+    
+    d1 = (np.log(V/D) + (r + 0.5*(sigma_V**2))*T)/(sigma_V*np.sqrt(T))
+    d2 = d1 - sigma_V*np.sqrt(T)
+    
+    y1 = E - (V*norm.cdf(d1) - np.exp(-r*T)*D*norm.cdf(d2))
+    y2 = E*sigma_E - V*norm.cdf(d1)*sigma_V
+
+    return [y1, y2]
+
+## single date simultaneous solver
+## sigma_E may be passed in from window_index to skip the return calculation
+## cascade lists the SIM_SOLVERS backends to try, cheapest first
+def sim_process(df, T=1.0, sigma_E=None, cascade=None):
+    if len(df) < 50:
+        return None
+
+
+    ## Initialize variables
+    row = df.iloc[-1]
+    gvkey = row.gvkey; fyr = row.fyr; permco = row.permco; permno = row.permno; date = row.date.date(); gsubind = row.gsubind; fic = row.fic
+    cusip = row.cusip
+    convergence = False
+
+    ## sort dataframe
+    df = df.sort_values(['gvkey', 'fyr', 'permco', 'permno', 'date'])
+
+    if row.D == 0 or np.isnan(row.D):
+        return None
+
+    ## calculate returns and standard deviations
+    if sigma_E is None:
+        df['E_ret'] = np.log(df.E/df.E.shift(1))*252
+        sigma_E = (df.E_ret/252).std()*np.sqrt(252) #maybe floor it with better reasoning for number
+    if sigma_E < 0.01:
+        sigma_E = 0.01
+
+    sigma_V = sigma_E*(df.E.iloc[-1]/(df.E.iloc[-1]+df.D.iloc[-1]))
+    if sigma_V < 0.01:
+        sigma_V = 0.01
+
+    t0 = time.time()
+    ## Solve the model
+    V, S, solver, nfev, failure = solve_sim(row.E, row.D, sigma_E, row.rf, T, x0=([row.E+row.D], [sigma_V]),
+                                            cascade=cascade or SIM_CASCADE)
+    fsolve_out = [V[0], S[0]]
+    solver = solver[0]; nfev = nfev[0]; failure = failure[0]
+    convergence = solver is not None
+
+    iteration_time = time.time() - t0
+
+    ## Distance -to-Default and PD
+    if not any(np.isnan(fsolve_out)):
+        DD = (np.log(fsolve_out[0]/row.D) +(row.rf - 0.5*fsolve_out[1])*T)/(fsolve_out[1]*np.sqrt(T))
+        PD = norm.cdf(-DD)
+    else:
+        DD = np.nan; PD = np.nan
+
+    ## return a dictionary 
+    result = {"gvkey":gvkey, "fyr":fyr, "permco":permco, "permno":permno, "date":date, "gsubind":gsubind, "fic":fic,
+              "A":row.A, "E":row.E, "D":row.D, "rf":row.rf, "DD":DD, "PD":PD,
+              "V":fsolve_out[0], "sigma_V":fsolve_out[1],  "convergence":convergence, "solver":solver,
+              "nfev":nfev, "failure":failure, "iteration_time":iteration_time, "cusip": cusip}
+    return result
+     
+#------------------------------
+# Two step iterative procedure
+#------------------------------
+
+## firm value solver takes daily inputs
+def merton_iter(V, sigma_V, E, sigma_E, D, rf, T):
+    
+    d1 = (np.log(V/D) + (rf + 0.5*(sigma_V**2))*T)/(sigma_V*np.sqrt(T))
+    d2 = d1 - sigma_V*np.sqrt(T)
+    
+    y = E - (V*norm.cdf(d1) - np.exp(-rf*T)*D*norm.cdf(d2))
+
+    return y
+
+## vectorized Newton iteration on merton_iter for every day at once
+## the call price is convex and increasing in V, so starting from V = E + D
+## the iterates decrease monotonically to the root
+## sigma_V may be a scalar or one value per day (e.g. several windows of a firm)
+## returns V, per-day convergence flags and Newton iteration counts (nit)
+def merton_iter_batch(sigma_V, E, D, rf, T, x0=None, xtol=1.49012e-08, max_iter=100):
+    E, D, rf = [np.asarray(a, dtype=float) for a in (E, D, rf)]
+    sigma_V = np.broadcast_to(np.asarray(sigma_V, dtype=float), E.shape)
+    sqrtT = np.sqrt(T)
+
+    V = E + D if x0 is None else np.array(x0, dtype=float, copy=True)
+    converged = np.zeros(E.shape[0], dtype=bool)
+    nit = np.zeros(E.shape[0], dtype=int)
+    active = np.isfinite(E) & np.isfinite(D) & np.isfinite(rf) & np.isfinite(V) & (D > 0) & (sigma_V > 0)
+
+    with np.errstate(all='ignore'):
+        for i in range(max_iter):
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            v = V[idx]; s = sigma_V[idx]; d = D[idx]; r = rf[idx]
+
+            d1 = (np.log(v/d) + (r + 0.5*(s**2))*T)/(s*sqrtT)
+            d2 = d1 - s*sqrtT
+            Nd1 = norm.cdf(d1)
+            f = v*Nd1 - np.exp(-r*T)*d*norm.cdf(d2) - E[idx]
+
+            v_new = v - f/Nd1
+            v_new = np.where(v_new > 0, v_new, 0.5*v)
+            V[idx] = v_new
+            nit[idx] += 1
+
+            bad = ~np.isfinite(v_new)
+            done = ~bad & (np.abs(v_new - v) <= xtol*np.abs(v_new))
+            converged[idx[done]] = True
+            active[idx[bad | done]] = False
+
+    V[~converged] = np.nan
+    return V, converged, nit
+
+## next sigma_V for the fixed point sigma_V = G(sigma_V) from the history of
+## (sigma_V, G(sigma_V)) pairs
+##   picard   plain iteration, sigma_V = G(sigma_V)
+##   aitken   Steffensen: a plain step, then Aitken's delta-squared extrapolation
+##            of the last three iterates, repeated
+##   anderson Anderson mixing over the last depth differences (the secant
+##            method on G(x) - x when depth=1)
+## an update that is not finite and positive falls back to the plain step
+def sigma_V_update(hist, accel="picard", depth=1):
+    x, g = hist[-1]
+    new = g
+    if accel == "aitken" and len(hist) % 2 == 0:
+        x0, x1 = hist[-2]; x2 = g
+        denom = x2 - 2*x1 + x0
+        if denom != 0:
+            new = x0 - (x1 - x0)**2/denom
+    elif accel == "anderson" and len(hist) >= 2:
+        h = np.array(hist[-(depth + 1):])
+        f = h[:, 1] - h[:, 0]
+        dF = np.diff(f); dG = np.diff(h[:, 1])
+        if np.all(np.isfinite(dF)) and np.any(dF != 0):
+            gamma = np.linalg.lstsq(dF.reshape(1, -1), f[-1:], rcond=None)[0]
+            new = g - dG @ gamma
+    elif accel not in ("picard", "aitken", "anderson"):
+        raise ValueError("unknown sigma_V acceleration: " + str(accel))
+
+    if not (np.isfinite(new) and new > 0):
+        new = g
+    return new
+
+## sigma_V tolerance and iteration cap of the two step procedure
+ITER_TOL = 0.001
+ITER_MAX = 10
+
+## two step process takes time series inputs by firm
+## df must have: gvkey, date, A, D, E, rf
+## sigma_E may be passed in from window_index to skip the return calculation
+## state carries the daily V from the previous month end of the same firm, used
+## as Newton starting values for the overlapping days and updated in place;
+## sigma_V always starts from the equity value as in a cold start, so a warm
+## run follows the same sigma_V iterates and stops at the same point (a
+## carried sigma_V stops at a different point within tol of the fixed point)
+## cascade lists the V_SOLVERS backends to try, cheapest first
+## accel picks the sigma_V update, see sigma_V_update
+def two_step_process(df, T, max_iter=ITER_MAX, tol=ITER_TOL, sigma_E=None, state=None, cascade=None, accel="picard"):
+    cascade = cascade or V_CASCADE
+    ## Initialize variables
+    last_row = df.iloc[-1]
+    df = df.sort_values(['gvkey', 'fyr', 'permco', 'permno', 'date'])
+    if sigma_E is None:
+        df['E_ret'] = np.log(df.E/df.E.shift(1))*252
+        sigma_E = (df.E_ret/252).std()*np.sqrt(252)
+    sigma_V = sigma_E*(df.E.iloc[-1]/(df.E.iloc[-1]+df.D.iloc[-1]))
+    if sigma_V < 0.01:
+        sigma_V = 0.01
+    df['V'] = np.nan
+
+    ## starting values for V, warm where the previous window overlaps
+    V0 = (df.E + df.D).values
+    if state:
+        if state.get('V') is not None:
+            V_prev = state['V'].reindex(df.date).values
+            V0 = np.where(np.isfinite(V_prev), V_prev, V0)
+    gvkey = last_row.gvkey; fyr = last_row.fyr; permco = last_row.permco; permno = last_row.permno; date = last_row.date.date(); gsubind = last_row.gsubind; fic=last_row.fic
+    cusip = last_row.cusip
+    #print("Processing row:", gvkey, fyr, permco, permno, date)
+    num_iter = 0; converge_check= np.nan; convergence = False; iteration_time = np.nan; solver = None
+    nfev = 0; failure = "insufficient data"; hist = []
+
+    ## start timer
+    t0 = time.time()
+
+    while num_iter <= max_iter:
+        num_iter += 1
+        valid = df[['E', 'D', 'rf']].notna().all(axis=1).values
+        if not valid.any(): break
+        x0 = V0[valid] if state is not None else None
+        V, stage, k = solve_V(sigma_V, df.E.values[valid], df.D.values[valid], df.rf.values[valid], T, x0=x0, cascade=cascade)
+        df.loc[valid,'V'] = V
+        nfev += k.sum()
+        ## deepest backend any day needed
+        solver = cascade[stage.max()] if stage.max() >= 0 else None
+        if state is not None:
+            V0 = np.where(np.isfinite(df.V.values), df.V.values, V0)
+        
+        valid_V = df['V'].dropna()
+        if len(valid_V) >= 50:
+            df['V_lag'] = df.V.shift(1)
+            df['V_ret'] = np.log(df.V/df.V_lag)*252
+            mean_V = df.V_ret.mean()
+            sigma_V_prime = (df.V_ret/252).std()*np.sqrt(252)
+
+            ## check tolerance
+            converge_check = np.abs(sigma_V_prime - sigma_V)
+            if converge_check <= tol:
+                convergence = True; failure = None
+                break
+            else:
+                hist.append((sigma_V, sigma_V_prime))
+                sigma_V = sigma_V_update(hist, accel)
+                failure = "non-convergence" if np.isfinite(sigma_V) else "overflow"
+        else:
+            ## days lost to non-finite solutions
+            convergence = False; failure = "overflow"
+    ## carry the solution to the next month end, cold start after a failure
+    if state is not None:
+        state.clear()
+        if convergence == True:
+            state.update({"V":pd.Series(df.V.values, index=df.date.values)})
+
+    ## calculate distance to default and probability of default
+    df = df.iloc[-1]
+    if convergence == True:
+        DD = (np.log(df.V/df.D) + (mean_V - 0.5*sigma_V**2))/sigma_V
+        PD = norm.cdf(-DD)
+    else:
+        DD = PD = V = sigma_V = mean_V = np.nan
+    iteration_time = time.time() - t0
+    ## return a dictionary 
+    result = {"gvkey":gvkey, "fyr":fyr, "permco":permco, "permno":permno, "date":date, "gsubind":gsubind, "fic":df.fic,
+              "A":df.A, "E":df.E, "D":df.D, "rf":df.rf, 
+              "DD":DD, "PD":PD, "V":df.V, "sigma_V":sigma_V, "mean_V":mean_V, 
+              "convergence":convergence, "iters":num_iter, "solver":solver, "nfev":nfev, "failure":failure,
+              "converge_check":converge_check, "iteration_time":iteration_time, "cusip":cusip}
+    return result
+
+#------------------------------------
+# Month end estimation by firm group
+#------------------------------------
+
+## month end estimation windows for one firm group, built once per group
+## start/end are row offsets into the date sorted sample (found with searchsorted
+## on the date_lag_250 calendar merge), so each window is sample.iloc[start:end]
+## sigma_E comes from cumulative sums of log returns and squared log returns
+def window_index(sample):
+    dates = sample.date.values
+    E = sample.E.values.astype(float)
+    ym = sample.date.dt.year.values*12 + sample.date.dt.month.values
+
+    ## last trading day of each month
+    end = np.flatnonzero(np.r_[ym[1:] != ym[:-1], True]) + 1
+    dt_lag = sample.date_lag_250.values[end - 1]
+    start = np.searchsorted(dates, dt_lag, side='right')
+    start = np.where(pd.isnull(dt_lag), end, np.minimum(start, end))
+
+    ## running sums of daily log returns
+    with np.errstate(all='ignore'):
+        ret = np.r_[np.nan, np.log(E[1:]/E[:-1])]
+    valid = np.isfinite(ret)
+    ret = np.where(valid, ret, 0.0)
+    c1 = np.r_[0.0, np.cumsum(ret)]
+    c2 = np.r_[0.0, np.cumsum(ret**2)]
+    cn = np.r_[0, np.cumsum(valid)]
+
+    ## returns inside [start, end) exclude the first day of the window
+    lo = np.minimum(start + 1, end)
+    n_ret = cn[end] - cn[lo]
+    s1 = c1[end] - c1[lo]
+    s2 = c2[end] - c2[lo]
+    with np.errstate(all='ignore'):
+        var = np.where(n_ret > 1, (s2 - s1**2/n_ret)/(n_ret - 1), np.nan)
+    sigma_E = np.sqrt(np.maximum(var, 0))*np.sqrt(252)
+
+    last = sample[['E', 'D', 'rf']].iloc[end - 1].notna().all(axis=1).values
+    ok = (end - start >= 50) & last
+
+    ## reason a window is not estimated
+    ## (zero debt rows never get here, load_panel drops them and counts them)
+    skip = np.where(~ok, "insufficient data", None)
+    windows = pd.DataFrame({"month_end": dates[end - 1], "start": start, "end": end,
+                            "n": end - start, "sigma_E": sigma_E, "ok": ok, "skip": skip})
+
+    ## incremental runs only estimate month ends after those already stored
+    if 'done_through' in sample and pd.notna(sample.done_through.iloc[0]):
+        windows = windows.loc[windows.month_end > sample.done_through.iloc[0]].reset_index(drop=True)
+    return windows
+
+## function to process the results by group
+def sim_by_group(sample, cascade=None):
+    results = []
+    sample = sample.sort_values('date')
+    windows = window_index(sample)
+
+    ## run simultaneous process for month end dates
+    for w in windows.loc[windows.ok].itertuples(index=False):
+        x = sim_process(sample.iloc[w.start:w.end], T=1, sigma_E=w.sigma_E, cascade=cascade)
+        if x is not None:
+            results.append(x)
+
+    return pd.DataFrame(results) if results else pd.DataFrame()
+
+## function to process the results by group
+## warm_start carries each month end's daily V into the next overlapping window
+def iter_by_group(sample, warm_start=False, cascade=None, accel="picard"):
+    results = []
+    sample = sample.sort_values('date')
+    windows = window_index(sample)
+    state = {} if warm_start else None
+
+    for w in windows.loc[windows.ok].itertuples(index=False):
+        x = two_step_process(sample.iloc[w.start:w.end], T=1, sigma_E=w.sigma_E, state=state, cascade=cascade, accel=accel)
+        results.append(x)
+    return pd.DataFrame(results) if results else pd.DataFrame()
+
+## compare warm and cold started runs of iter_by_group for one group
+## both runs take the same sigma_V iterates, so firm-months converged in
+## either run should be converged in both and agree to solver precision
+def check_warm_start(sample, tol=ITER_TOL):
+    cold = iter_by_group(sample)
+    warm = iter_by_group(sample, warm_start=True)
+    if cold.empty:
+        return {"n":0, "max_diff":np.nan, "max_dd_diff":np.nan, "within_tol":True, "same_convergence":True,
+                "iters_cold":0, "iters_warm":0, "nfev_cold":0, "nfev_warm":0}
+    both = (cold.convergence & warm.convergence).values
+    diff = np.abs(cold.sigma_V.values[both] - warm.sigma_V.values[both])
+    dd_diff = np.abs(cold.DD.values[both] - warm.DD.values[both])
+    max_diff = diff.max() if diff.size else 0.0
+    max_dd_diff = np.nanmax(dd_diff) if dd_diff.size else 0.0
+    return {"n":int(both.sum()), "max_diff":max_diff, "max_dd_diff":max_dd_diff,
+            "within_tol":bool(max_diff <= tol and max_dd_diff <= tol),
+            "same_convergence":bool((cold.convergence.values == warm.convergence.values).all()),
+            "iters_cold":int(cold.iters.sum()), "iters_warm":int(warm.iters.sum()),
+            "nfev_cold":int(cold.nfev.sum()), "nfev_warm":int(warm.nfev.sum())}
+
+## iteration counts and converged share of each sigma_V update side by side
+def compare_acceleration(samples, methods=("picard", "aitken", "anderson"), warm_start=False):
+    rows = []
+    for accel in methods:
+        out = [iter_by_group(s, warm_start=warm_start, accel=accel) for s in samples]
+        out = pd.concat(out, ignore_index=True) if out else pd.DataFrame()
+        if out.empty:
+            continue
+        rows.append({"accel":accel, "firm_months":len(out), "mean_iters":out.iters.mean(),
+                     "max_iters":out.iters.max(), "converged":out.convergence.mean(),
+                     "nfev":out.nfev.sum()})
+    return pd.DataFrame(rows)
+
+#-----------------------------------------
+# Batched simultaneous procedure
+# solves all firm-months in one array call
+#-----------------------------------------
+
+## identifiers and balance sheet values carried to the output
+SIM_ID_COLS = ['gvkey', 'fyr', 'permco', 'permno', 'date', 'gsubind', 'fic', 'A', 'E', 'D', 'rf', 'cusip']
+
+## month end inputs for the simultaneous solver, one row per firm-month
+def sim_inputs_by_group(sample):
+    sample = sample.sort_values('date')
+    windows = window_index(sample)
+    windows = windows.loc[windows.ok]
+
+    ## same sigma_E floor and zero debt check as sim_process
+    x = sample.iloc[windows.end.values - 1][SIM_ID_COLS].reset_index(drop=True)
+    x['date'] = x.date.dt.date
+    x['sigma_E'] = np.maximum(windows.sigma_E.values, 0.01)
+    return x.loc[x.D != 0].reset_index(drop=True)
+
+## vectorized Newton iteration on merton_sim with the analytic Jacobian
+## returns V, sigma_V, per-row convergence flags and Newton iteration counts (nit)
+def merton_sim_batch(E, D, sigma_E, r, T=1.0, x0=None, xtol=1.49012e-08, max_iter=100):
+    E, D, sigma_E, r = [np.asarray(a, dtype=float) for a in (E, D, sigma_E, r)]
+    n = E.shape[0]
+    sqrtT = np.sqrt(T)
+
+    ## same starting values as sim_process
+    if x0 is None:
+        V = E + D
+        sigma_V = np.maximum(sigma_E*E/(E+D), 0.01)
+    else:
+        V = np.array(x0[0], dtype=float, copy=True)
+        sigma_V = np.array(x0[1], dtype=float, copy=True)
+
+    converged = np.zeros(n, dtype=bool)
+    nit = np.zeros(n, dtype=int)
+    active = np.isfinite(E) & np.isfinite(D) & np.isfinite(sigma_E) & np.isfinite(r) & (E > 0) & (D > 0)
+
+    with np.errstate(all='ignore'):
+        for i in range(max_iter):
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            v = V[idx]; s = sigma_V[idx]
+            e = E[idx]; d = D[idx]; se = sigma_E[idx]; rr = r[idx]
+
+            d1 = (np.log(v/d) + (rr + 0.5*(s**2))*T)/(s*sqrtT)
+            d2 = d1 - s*sqrtT
+            Nd1 = norm.cdf(d1); Nd2 = norm.cdf(d2); nd1 = norm.pdf(d1)
+
+            ## residuals (negated merton_sim) and Jacobian
+            f1 = v*Nd1 - np.exp(-rr*T)*d*Nd2 - e
+            f2 = v*Nd1*s - e*se
+            j11 = Nd1
+            j12 = v*nd1*sqrtT
+            j21 = s*Nd1 + nd1/sqrtT
+            j22 = v*Nd1 - v*nd1*d2
+            det = j11*j22 - j12*j21
+
+            v_new = v - (f1*j22 - f2*j12)/det
+            s_new = s - (j11*f2 - j21*f1)/det
+
+            ## keep the iterates positive
+            v_new = np.where(v_new > 0, v_new, 0.5*v)
+            s_new = np.where(s_new > 0, s_new, 0.5*s)
+
+            V[idx] = v_new; sigma_V[idx] = s_new
+            nit[idx] += 1
+
+            ## drop rows that blew up or converged
+            bad = ~(np.isfinite(v_new) & np.isfinite(s_new))
+            done = ~bad & (np.abs(v_new - v) <= xtol*np.abs(v_new)) & (np.abs(s_new - s) <= xtol*np.abs(s_new))
+            converged[idx[done]] = True
+            active[idx[bad | done]] = False
+
+    V[~converged] = np.nan
+    sigma_V[~converged] = np.nan
+    return V, sigma_V, converged, nit
+
+## batched replacement for sim_by_group over the output of sim_inputs_by_group
+## rows the vectorized Newton step misses fall through the rest of the cascade
+def sim_batch(inputs, T=1.0, cascade=None):
+    V, sigma_V, solver, nfev, failure = solve_sim(inputs.E.values, inputs.D.values, inputs.sigma_E.values,
+                                                  inputs.rf.values, T, cascade=cascade or SIM_CASCADE)
+
+    ## Distance-to-Default and PD as in sim_process
+    with np.errstate(all='ignore'):
+        DD = (np.log(V/inputs.D.values) + (inputs.rf.values - 0.5*sigma_V)*T)/(sigma_V*np.sqrt(T))
+    PD = norm.cdf(-DD)
+
+    result = inputs[['gvkey', 'fyr', 'permco', 'permno', 'date', 'gsubind', 'fic', 'A', 'E', 'D', 'rf']].copy()
+    result['DD'] = DD; result['PD'] = PD
+    result['V'] = V; result['sigma_V'] = sigma_V
+    result['convergence'] = pd.notna(solver)
+    result['solver'] = solver
+    result['nfev'] = nfev
+    result['failure'] = failure
+    ## the batch is solved at once, so there is no wall time per firm-month;
+    ## its cost shows up per chunk in the run_panel stats
+    result['iteration_time'] = np.nan
+    result['cusip'] = inputs['cusip'].values
+    return result.reset_index(drop=True)
+
+#-----------------------------------------
+# Solver backends
+# registries of interchangeable solvers,
+# tried in order by a cascade until one
+# passes the residual check
+#-----------------------------------------
+
+## analytic Jacobian of merton_sim
+def merton_sim_jac(x, E, D, sigma_E, r, T):
+    V = x[0]
+    sigma_V = x[1]
+    sqrtT = np.sqrt(T)
+
+    d1 = (np.log(V/D) + (r + 0.5*(sigma_V**2))*T)/(sigma_V*sqrtT)
+    d2 = d1 - sigma_V*sqrtT
+    Nd1 = norm.cdf(d1); nd1 = norm.pdf(d1)
+
+    return np.array([[-Nd1, -V*nd1*sqrtT],
+                     [-(sigma_V*Nd1 + nd1/sqrtT), -(V*Nd1 - V*nd1*d2)]])
+
+## relative residual check used to accept a solution from any backend
+def sim_residual_ok(V, sigma_V, E, D, sigma_E, r, T, rtol=1e-6):
+    with np.errstate(all='ignore'):
+        y1, y2 = merton_sim([V, sigma_V], E, D, sigma_E, r, T)
+        return (np.isfinite(V) & np.isfinite(sigma_V) & (V > 0) & (sigma_V > 0)
+                & (np.abs(y1) <= rtol*E) & (np.abs(y2) <= rtol*E*sigma_E))
+
+def iter_residual_ok(V, sigma_V, E, D, rf, T, rtol=1e-6):
+    with np.errstate(all='ignore'):
+        y = merton_iter(V, sigma_V, E, np.nan, D, rf, T)
+        return np.isfinite(V) & (V > 0) & (np.abs(y) <= rtol*E)
+
+## wrap a single row solver as an array backend returning (V, sigma_V, nfev)
+def _sim_rows(solve_row):
+    def backend(E, D, sigma_E, r, T, x0):
+        n = len(E)
+        V = np.full(n, np.nan); sigma_V = np.full(n, np.nan); nfev = np.zeros(n, dtype=int)
+        for i in range(n):
+            try:
+                (V[i], sigma_V[i]), nfev[i] = solve_row(E[i], D[i], sigma_E[i], r[i], T, np.array([x0[0][i], x0[1][i]]))
+            except Exception:
+                pass
+        return V, sigma_V, nfev
+    return backend
+
+## each Newton step evaluates the residuals once, the analytic Jacobian reuses
+## d1 and d2 and is not counted, as scipy leaves fprime calls out of nfev
+def _sim_newton(E, D, sigma_E, r, T, x0):
+    V, sigma_V, converged, nit = merton_sim_batch(E, D, sigma_E, r, T, x0=x0)
+    nfev = nit
+    return V, sigma_V, nfev
+
+def _sim_fsolve(E, D, sigma_E, r, T, x0):
+    x, info, ier, msg = fsolve(merton_sim, x0=x0, args=(E, D, sigma_E, r, T), full_output=True)
+    return x, info['nfev']
+
+def _sim_root(method):
+    def solve_row(E, D, sigma_E, r, T, x0):
+        out = root(merton_sim, x0=x0, args=(E, D, sigma_E, r, T), jac=merton_sim_jac, method=method)
+        return out.x, out.nfev
+    return solve_row
+
+def _sim_least_squares(E, D, sigma_E, r, T, x0):
+    jac = lambda x, *args: merton_sim_jac(x, *args)
+    out = least_squares(merton_sim, x0=x0, args=(E, D, sigma_E, r, T), jac=jac,
+                        bounds=([1e-8, 1e-8], [np.inf, np.inf]), x_scale='jac')
+    return out.x, out.nfev
+
+## the call price lies between V - D*exp(-rT) and V, so the root of merton_iter
+## is bracketed by [E, E + D*exp(-rT)], padded above for rounding
+def V_bracket(E, D, rf, T):
+    return E, (E + D*max(1.0, np.exp(-rf*T)))*(1 + 1e-8)
+
+## bracketed 1-D reduction: for a given sigma_V, V solves merton_iter on V_bracket
+## and sigma_V then solves the volatility equation on (0, sigma_E], where it changes sign
+def _sim_bracket(E, D, sigma_E, r, T, x0):
+    nfev = [0]
+    def V_of(sigma_V):
+        nfev[0] += 1
+        return brentq(merton_iter, *V_bracket(E, D, r, T), args=(sigma_V, E, sigma_E, D, r, T))
+    def g(sigma_V):
+        V = V_of(sigma_V)
+        return merton_sim([V, sigma_V], E, D, sigma_E, r, T)[1]
+    sigma_V = brentq(g, 1e-6, sigma_E)
+    return (V_of(sigma_V), sigma_V), nfev[0]
+
+SIM_SOLVERS = {"newton":_sim_newton,
+               "fsolve":_sim_rows(_sim_fsolve),
+               "hybr":_sim_rows(_sim_root("hybr")),
+               "lm":_sim_rows(_sim_root("lm")),
+               "least_squares":_sim_rows(_sim_least_squares),
+               "bracket":_sim_rows(_sim_bracket)}
+
+## cheapest first, later backends only see the rows that failed
+SIM_CASCADE = ("newton", "hybr", "least_squares", "bracket")
+
+## solve merton_sim for arrays of firm-months through a cascade of backends
+## returns V, sigma_V, the backend that succeeded for each row (None if all
+## failed), the function evaluations spent on each row and the failure class
+## of rows no backend solved ("overflow" if the last attempt was not finite)
+def solve_sim(E, D, sigma_E, r, T=1.0, x0=None, cascade=SIM_CASCADE):
+    E, D, sigma_E, r = [np.atleast_1d(np.asarray(a, dtype=float)) for a in (E, D, sigma_E, r)]
+    n = E.shape[0]
+    if x0 is None:
+        x0 = (E + D, np.maximum(sigma_E*E/(E+D), 0.01))
+
+    V = np.full(n, np.nan); sigma_V = np.full(n, np.nan)
+    solver = np.full(n, None, dtype=object); nfev = np.zeros(n, dtype=int)
+    failure = np.full(n, None, dtype=object)
+    todo = np.arange(n)
+    for name in cascade:
+        if todo.size == 0:
+            break
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter("ignore")
+            v, s, k = SIM_SOLVERS[name](E[todo], D[todo], sigma_E[todo], r[todo], T,
+                                        (np.asarray(x0[0], dtype=float)[todo], np.asarray(x0[1], dtype=float)[todo]))
+        nfev[todo] += k
+        ok = sim_residual_ok(v, s, E[todo], D[todo], sigma_E[todo], r[todo], T)
+        V[todo[ok]] = v[ok]; sigma_V[todo[ok]] = s[ok]; solver[todo[ok]] = name
+        ## a later backend clears the failure an earlier one recorded
+        failure[todo[ok]] = None
+        failure[todo[~ok]] = np.where(np.isfinite(v[~ok]) & np.isfinite(s[~ok]), "non-convergence", "overflow")
+        todo = todo[~ok]
+
+    return V, sigma_V, solver, nfev, failure
+
+## V backends for the two step procedure return (V, nfev) for arrays of days
+## one residual evaluation per Newton step, the derivative N(d1) comes with it
+def _iter_newton(sigma_V, E, D, rf, T, x0):
+    V, converged, nit = merton_iter_batch(sigma_V, E, D, rf, T, x0=x0)
+    nfev = nit
+    return V, nfev
+
+def _iter_rows(solve_row):
+    def backend(sigma_V, E, D, rf, T, x0):
+        n = len(E)
+        V = np.full(n, np.nan); nfev = np.zeros(n, dtype=int)
+        for i in range(n):
+            try:
+                V[i], nfev[i] = solve_row(sigma_V[i], E[i], D[i], rf[i], T, x0[i])
+            except Exception:
+                pass
+        return V, nfev
+    return backend
+
+def _iter_fsolve(sigma_V, E, D, rf, T, x0):
+    x, info, ier, msg = fsolve(merton_iter, x0=x0, args=(sigma_V, E, np.nan, D, rf, T), full_output=True)
+    return x[0], info['nfev']
+
+def _iter_brentq(sigma_V, E, D, rf, T, x0):
+    V, out = brentq(merton_iter, *V_bracket(E, D, rf, T), args=(sigma_V, E, np.nan, D, rf, T), full_output=True)
+    return V, out.function_calls
+
+V_SOLVERS = {"newton":_iter_newton,
+             "fsolve":_iter_rows(_iter_fsolve),
+             "brentq":_iter_rows(_iter_brentq)}
+
+V_CASCADE = ("newton", "brentq")
+
+## solve merton_iter for a window of days through a cascade of backends
+## returns V, the position in the cascade of the backend used for each day
+## (-1 if all failed) and the function evaluations spent on each day
+def solve_V(sigma_V, E, D, rf, T, x0=None, cascade=V_CASCADE):
+    E, D, rf = [np.asarray(a, dtype=float) for a in (E, D, rf)]
+    n = E.shape[0]
+    sigma_V = np.broadcast_to(np.asarray(sigma_V, dtype=float), (n,))
+    x0 = E + D if x0 is None else np.asarray(x0, dtype=float)
+
+    V = np.full(n, np.nan); stage = np.full(n, -1); nfev = np.zeros(n, dtype=int)
+    todo = np.arange(n)
+    for k, name in enumerate(cascade):
+        if todo.size == 0:
+            break
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter("ignore")
+            v, calls = V_SOLVERS[name](sigma_V[todo], E[todo], D[todo], rf[todo], T, x0[todo])
+        nfev[todo] += calls
+        ok = iter_residual_ok(v, sigma_V[todo], E[todo], D[todo], rf[todo], T)
+        V[todo[ok]] = v[ok]; stage[todo[ok]] = k
+        todo = todo[~ok]
+
+    return V, stage, nfev
@@ -0,0 +1,191 @@
+#------------------------------------------
+# Typed columnar storage for the merged
+# panel and the DD outputs
+# parquet partitioned by year_month with
+# int32 keys, dictionary encoded strings
+# and native dates
+#------------------------------------------
+
+import os, glob, shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+## column types, whichever of these a frame has
+INT32_COLS = ['gvkey', 'permco', 'permno']
+INT8_COLS = ['fyr']
+DICT_COLS = ['cusip', 'gsubind', 'fic', 'conm']
+DATE_COLS = ['date', 'datadate', 'date_lag_250', 'dt_start', 'dt_end']
+
+## hive partition column, year and month of date
+PARTITION = 'year_month'
+
+#---------------------------
+# Typed tables
+#---------------------------
+
+## strings as they were meant, e.g. gsubind 45102010.0 -> '45102010', cusip
+## kept as text so leading zeros survive
+def _as_string(s):
+    if pd.api.types.is_numeric_dtype(s):
+        return s.map(lambda x: None if pd.isna(x) else "%d" % x if float(x).is_integer() else str(x))
+    return s.astype(object).where(s.notna(), None).map(lambda x: x if x is None else str(x))
+
+def _column(s, name):
+    if name in INT32_COLS:
+        return pa.array(pd.to_numeric(s), from_pandas=True).cast(pa.int32())
+    if name in INT8_COLS:
+        return pa.array(pd.to_numeric(s), from_pandas=True).cast(pa.int8())
+    if name in DICT_COLS:
+        codes, uniques = pd.factorize(s)
+        values = pa.array(_as_string(pd.Series(uniques)), type=pa.string())
+        return pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0, type=pa.int32()), values)
+    if name in DATE_COLS:
+        return pa.array(pd.to_datetime(s), from_pandas=True).cast(pa.date32())
+    if s.dtype == object:
+        return pa.array(s, from_pandas=True)
+    return pa.array(s.to_numpy(), from_pandas=True)
+
+## arrow table with the storage types and the year_month partition column
+def arrow_table(df, date_col='date'):
+    table = pa.table({c: _column(df[c], c) for c in df.columns})
+    month = pd.to_datetime(df[date_col]).to_numpy().astype('datetime64[M]').astype(str)
+    return table.append_column(PARTITION, pa.array(month))
+
+#---------------------------
+# Write
+#---------------------------
+
+## write df as a year_month partitioned dataset under path
+##   overwrite  replace the whole dataset
+##   replace    rewrite only the months present in df, keep the others
+##   append     add files next to the existing ones (e.g. streamed parts)
+def write_dataset(df, path, mode="overwrite", date_col='date', part=0):
+    if mode == "overwrite":
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    if len(df) == 0:
+        return 0
+    table = arrow_table(df, date_col)
+    ds.write_dataset(table, path, format="parquet",
+                     partitioning=ds.partitioning(pa.schema([(PARTITION, pa.string())]), flavor="hive"),
+                     basename_template="part-%05d-{i}.parquet" % part,
+                     existing_data_behavior="delete_matching" if mode == "replace" else "overwrite_or_ignore")
+    return len(df)
+
+#---------------------------
+# Read
+#---------------------------
+
+## read a dataset back as a DataFrame with datetime64 dates and categorical strings
+## only the columns asked for are read, and only the year_month partitions
+## that can hold dates in [start, end]
+def read_dataset(path, columns=None, start=None, end=None, filter=None):
+    data = ds.dataset(path, format="parquet", partitioning="hive")
+    expr = filter
+    if start is not None:
+        e = (ds.field(PARTITION) >= pd.Timestamp(start).strftime("%Y-%m")) & \
+            (ds.field('date') >= pa.scalar(pd.Timestamp(start).date(), pa.date32()))
+        expr = e if expr is None else expr & e
+    if end is not None:
+        e = (ds.field(PARTITION) <= pd.Timestamp(end).strftime("%Y-%m")) & \
+            (ds.field('date') <= pa.scalar(pd.Timestamp(end).date(), pa.date32()))
+        expr = e if expr is None else expr & e
+    if columns is None:
+        columns = [c for c in data.schema.names if c != PARTITION]
+    table = data.to_table(columns=columns, filter=expr)
+    return table.to_pandas(date_as_object=False)
+
+## size on disk in MB
+def dataset_mb(path):
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True))/2**20
+
+#---------------------------
+# DD stage loader
+#---------------------------
+
+## merged panel columns the DD engines read, and their panel names
+LOAD_COLS = ['gvkey', 'fyr', 'permco', 'permno', 'date', 'gsubind', 'fic', 'cusip',
+             'assets', 'mkt_cap', 'face_value_debt', 'tyd01y']
+PANEL_NAMES = {"assets":"A", "mkt_cap":"E", "face_value_debt":"D", "tyd01y":"rf"}
+SORT_KEYS = ['gvkey', 'fyr', 'permco', 'permno', 'date']
+
+## trading days in the equity volatility window
+LAG_DAYS = 250
+
+## bytes per row once loaded: categorical codes, int32 keys, int8 fyr, 8 byte dates and floats
+def estimate_mb(path, columns=LOAD_COLS, start=None, end=None):
+    data = ds.dataset(path, format="parquet", partitioning="hive")
+    expr = None
+    if start is not None:
+        expr = ds.field(PARTITION) >= pd.Timestamp(start).strftime("%Y-%m")
+    if end is not None:
+        e = ds.field(PARTITION) <= pd.Timestamp(end).strftime("%Y-%m")
+        expr = e if expr is None else expr & e
+    width = sum(4 if c in DICT_COLS + INT32_COLS else 1 if c in INT8_COLS else 8 for c in columns)
+    return data.count_rows(filter=expr)*(width + 8)/2**20
+
+## smallest integer types, and float32 where every value survives the round trip
+## keys are left at their storage types so they still match stored results
+def downcast(df, columns=None):
+    for c in columns or df.columns:
+        s = df[c]
+        if pd.api.types.is_integer_dtype(s):
+            df[c] = pd.to_numeric(s, downcast='integer')
+        elif pd.api.types.is_float_dtype(s) and s.dtype != np.float32:
+            x = s.to_numpy(); y = x.astype(np.float32)
+            if np.array_equal(y.astype(x.dtype), x, equal_nan=True):
+                df[c] = y
+    return df
+
+## MB per column
+def footprint(df):
+    return df.memory_usage(index=True, deep=True)/2**20
+
+## the DD panel: only LOAD_COLS are read, rows with missing or zero E, zero D
+## or zero rf are dropped and the rest sorted by SORT_KEYS in one copy,
+## date_lag_250 comes from the trading calendar by lookup rather than a merge
+## budget_mb refuses a load whose estimate (twice the panel, for the sort) is over it
+def load_panel(path, market_dates, start=None, end=None, budget_mb=None):
+    if budget_mb is not None:
+        need = 2*estimate_mb(path, LOAD_COLS, start, end)
+        if need > budget_mb:
+            raise MemoryError("panel needs about %.0f MB, over the %d MB budget, narrow start/end" % (need, budget_mb))
+
+    df = read_dataset(path, columns=LOAD_COLS, start=start, end=end)
+    df.rename(columns=PANEL_NAMES, inplace=True)
+    print("Rows read:", len(df))
+    print("Rows missing E:", df.E.isna().sum())
+    print("Rows with zero E, D or rf:", (~(df[['E', 'D', 'rf']] != 0).all(axis=1)).sum())
+    print("Rows with zero debt:", (df.D == 0).sum())
+
+    ## filter and sort with a single take
+    keep = np.flatnonzero(df.E.notna().to_numpy() & (df[['E', 'D', 'rf']] != 0).all(axis=1).to_numpy())
+    keys = [df[c].to_numpy()[keep] for c in SORT_KEYS]
+    df = df.take(keep[np.lexsort(keys[::-1])])
+    df.reset_index(drop=True, inplace=True)
+    del keys, keep
+
+    ## lagged trading date by position in the calendar
+    cal = np.unique(pd.to_datetime(market_dates['date']).to_numpy().astype(df.date.dtype))
+    lagged = np.full(len(cal), np.datetime64('NaT'), dtype=cal.dtype)
+    lagged[LAG_DAYS:] = cal[:len(cal) - LAG_DAYS]
+    date = df.date.to_numpy()
+    lag = np.full(len(df), np.datetime64('NaT'), dtype=cal.dtype)
+    if len(cal):
+        pos = np.minimum(np.searchsorted(cal, date), len(cal) - 1)
+        found = cal[pos] == date
+        lag[found] = lagged[pos[found]]
+    df['date_lag_250'] = lag
+
+    downcast(df, [c for c in df.columns if c not in SORT_KEYS])
+    dup = np.ones(max(len(df) - 1, 0), dtype=bool)
+    for c in SORT_KEYS:
+        a = df[c].to_numpy()
+        dup &= a[1:] == a[:-1]
+    print("Duplicated keys:", int(dup.sum()))
+    mb = footprint(df)
+    print("Panel footprint (MB):", round(mb.sum(), 1))
+    print(mb.round(1).to_string())
+    return df
@@ -0,0 +1,167 @@
+#------------------------------------------
+# Batched work scheduler for merton_DD.py
+# panel in shared memory, workers get
+# (start, end) row offsets into it
+#------------------------------------------
+
+import os, time
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+## primary keys, sorted panel must be contiguous by group
+GROUP_KEYS = ['gvkey', 'fyr', 'permco', 'permno']
+
+## numeric columns the engines read
+PANEL_COLS = GROUP_KEYS + ['date', 'date_lag_250', 'A', 'E', 'D', 'rf']
+
+## shared too when present, e.g. done_through for incremental runs
+OPTIONAL_COLS = ['done_through']
+
+## string (or categorical) columns stored as integer codes
+CODED_COLS = ['gsubind', 'fic', 'cusip']
+
+## panel attached in each worker
+_panel = {}
+
+#---------------------------
+# Shared memory panel
+#---------------------------
+
+## copy the sorted panel into shared memory, one block per column
+## string columns are factorized, categories stay in the parent
+def share_panel(df):
+    arrays = {c: df[c].to_numpy() for c in PANEL_COLS + [c for c in OPTIONAL_COLS if c in df]}
+    categories = {}
+    for c in CODED_COLS:
+        codes, categories[c] = pd.factorize(df[c])
+        arrays[c] = codes.astype(np.int32)
+
+    spec = {}; blocks = []
+    for c, a in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[:] = a
+        spec[c] = (shm.name, a.dtype.str, a.shape[0])
+        blocks.append(shm)
+
+    return {"spec":spec, "blocks":blocks, "categories":categories}
+
+## free the shared memory blocks
+def release_panel(panel):
+    for shm in panel["blocks"]:
+        shm.close()
+        shm.unlink()
+
+## worker initializer, map the shared blocks without copying
+def _attach(spec):
+    for c, (name, dtype, n) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _panel[c] = (shm, np.ndarray((n,), dtype=np.dtype(dtype), buffer=shm.buf))
+
+#---------------------------
+# Cost balanced chunks
+#---------------------------
+
+## (start, end) row offsets of each group in a panel sorted by GROUP_KEYS
+def group_bounds(df):
+    if len(df) == 0:
+        return np.zeros((0, 2), dtype=int)
+    keys = df[GROUP_KEYS].to_numpy()
+    new = np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)]
+    start = np.flatnonzero(new)
+    end = np.r_[start[1:], len(df)]
+    return np.column_stack([start, end])
+
+## pack groups into chunks of roughly equal row count
+## large firms get a chunk of their own, small firms are batched together
+## chunks are returned largest first so the long ones start early
+def balanced_chunks(bounds, processes, chunks_per_process=4):
+    rows = bounds[:, 1] - bounds[:, 0]
+    target = max(rows.sum()/max(processes*chunks_per_process, 1), 1)
+
+    chunks = []; current = []; size = 0
+    for i in np.argsort(-rows, kind='stable'):
+        current.append(i); size += rows[i]
+        if size >= target:
+            chunks.append((size, sorted(current))); current = []; size = 0
+    if current:
+        chunks.append((size, sorted(current)))
+
+    chunks.sort(key=lambda x: -x[0])
+    return [bounds[idx] for size, idx in chunks]
+
+#---------------------------
+# Worker
+#---------------------------
+
+## run the engine over every group in a chunk, then finish() over the chunk
+## results go back as a dict of numpy arrays rather than DataFrames
+def _run_chunk(args):
+    i, engine, finish, ranges, kwargs = args
+    t0 = time.time()
+    results = []
+    for start, end in ranges:
+        sample = pd.DataFrame({c: a[start:end] for c, (shm, a) in _panel.items()})
+        x = engine(sample, **kwargs)
+        if x is not None and len(x) > 0:
+            results.append(x)
+
+    stats = {"chunk":i, "pid":os.getpid(), "groups":len(ranges), "rows":int(sum(e - s for s, e in ranges))}
+    if not results:
+        return dict(stats, seconds=time.time() - t0, out=None)
+    out = pd.concat(results, ignore_index=True)
+    if finish is not None:
+        out = finish(out)
+    out['date'] = pd.to_datetime(out['date'])
+    return dict(stats, seconds=time.time() - t0, out={c: out[c].to_numpy() for c in out.columns})
+
+#---------------------------
+# Scheduler
+#---------------------------
+
+## decode the string columns of a result
+def _decode(out, categories):
+    for c in CODED_COLS:
+        if c in out:
+            codes = out[c].to_numpy().astype(int)
+            out[c] = np.where(codes >= 0, categories[c].to_numpy(dtype=object)[codes], np.nan)
+    return out
+
+## run engine(sample, **kwargs) over every firm group of a sorted panel
+## finish, if given, runs in the worker over each chunk's combined output
+## (e.g. sim_batch over sim_inputs_by_group)
+## returns the concatenated results in key and date order
+## per chunk worker statistics are appended to stats when a list is given
+## on_chunk(groups, out) is called in the parent as each chunk completes, with
+## the keys of every group in the chunk and its decoded results (or None)
+def run_panel(df, engine, processes=None, chunks_per_process=4, stats=None, finish=None, on_chunk=None, **kwargs):
+    processes = processes or mp.cpu_count()
+    bounds = group_bounds(df)
+    chunks = balanced_chunks(bounds, processes, chunks_per_process)
+    panel = share_panel(df)
+
+    results = []
+    try:
+        with mp.Pool(processes=processes, initializer=_attach, initargs=(panel["spec"],)) as pool:
+            tasks = [(i, engine, finish, c, kwargs) for i, c in enumerate(chunks)]
+            for x in pool.imap_unordered(_run_chunk, tasks):
+                if stats is not None:
+                    stats.append({k: x[k] for k in ("pid", "groups", "rows", "seconds")})
+                out = None
+                if x["out"] is not None:
+                    out = _decode(pd.DataFrame(x["out"]), panel["categories"])
+                    results.append(out)
+                if on_chunk is not None:
+                    on_chunk(df[GROUP_KEYS].iloc[chunks[x["chunk"]][:, 0]].reset_index(drop=True), out)
+            pool.close()
+            pool.join()
+    finally:
+        release_panel(panel)
+
+    if not results:
+        return pd.DataFrame()
+    out = pd.concat(results, ignore_index=True)
+    out = out.sort_values(GROUP_KEYS + ['date'], kind='stable').reset_index(drop=True)
+    out['date'] = out['date'].dt.date
+    return out
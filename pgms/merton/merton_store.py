@@ -0,0 +1,159 @@
+#------------------------------------------
+# Local store of the raw Merton source
+# tables with a high-water mark per table
+# so a refresh only fetches rows past it
+#------------------------------------------
+
+import os, glob, json, shutil
+import pandas as pd
+from merton_join import quarter_windows, carry_forward, carry_crossed
+from wrds_extract import extract_merton, co_ifndq_window
+
+## refresh modes
+##   full         clear the store and fetch the whole sample
+##   incremental  fetch CRSP days after the last stored date and recent Compustat quarters
+MODES = ["full", "incremental"]
+
+## Compustat quarters from this many quarters before the stored datadate mark
+## are fetched again, filings arrive months after datadate and get restated
+REFETCH_QTRS = 4
+
+CRSP_KEYS = ['permno', 'date']
+CO_KEYS = ['gvkey', 'fyr', 'datadate']
+
+def _write(df, path):
+    tmp = path + ".tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+#---------------------------
+# Watermarks
+#---------------------------
+
+def read_watermarks(path):
+    f = os.path.join(path, "watermarks.json")
+    if not os.path.exists(f):
+        return {}
+    with open(f) as fh:
+        return json.load(fh)
+
+def write_watermarks(path, marks):
+    f = os.path.join(path, "watermarks.json")
+    with open(f + ".tmp", "w") as fh:
+        json.dump(marks, fh, indent=1, default=str)
+    os.replace(f + ".tmp", f)
+
+#---------------------------
+# CRSP by year
+#---------------------------
+
+def _crsp_files(path):
+    return sorted(glob.glob(os.path.join(path, "crsp", "year=*.parquet")))
+
+def read_crsp(path, columns=None):
+    files = _crsp_files(path)
+    if not files:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([pd.read_parquet(f, columns=columns) for f in files], ignore_index=True)
+
+## add new CRSP days to their year files, a re-fetched day replaces the stored one
+def merge_crsp(path, new):
+    os.makedirs(os.path.join(path, "crsp"), exist_ok=True)
+    new = new.assign(date=pd.to_datetime(new.date))
+    for year, x in new.groupby(new.date.dt.year):
+        f = os.path.join(path, "crsp", "year=%d.parquet" % year)
+        if os.path.exists(f):
+            x = pd.concat([pd.read_parquet(f), x], ignore_index=True)
+        x = x.drop_duplicates(CRSP_KEYS, keep='last').sort_values(CRSP_KEYS)
+        _write(x, f)
+
+#---------------------------
+# Compustat quarters
+#---------------------------
+
+## gvkeys whose rows differ between two versions of the same quarters
+def changed_gvkeys(old, new, columns):
+    def rows(x):
+        return pd.Series(pd.util.hash_pandas_object(x[columns], index=False).values, index=x.gvkey.values)
+    a = set(rows(old).items()); b = set(rows(new).items())
+    return sorted({g for g, h in a ^ b})
+
+## replace stored quarters in [lo, hi] with the re-fetched ones
+## returns the new table and the gvkeys whose quarters changed
+def merge_co_ifndq(stored, fetched, lo, hi):
+    fetched = fetched.assign(datadate=pd.to_datetime(fetched.datadate))
+    if stored is None or stored.empty:
+        return fetched.sort_values(CO_KEYS).reset_index(drop=True), sorted(fetched.gvkey.dropna().unique())
+    window = (stored.datadate >= lo) & (stored.datadate <= hi)
+    columns = [c for c in stored.columns if c in fetched]
+    changed = changed_gvkeys(stored.loc[window], fetched, columns)
+    out = pd.concat([stored.loc[~window], fetched[stored.columns]], ignore_index=True)
+    return out.sort_values(CO_KEYS).reset_index(drop=True), changed
+
+#---------------------------
+# Refresh
+#---------------------------
+
+## bring the store at path up to date and return the CRSP year files (never
+## loaded together), co_ifndq (with reporting windows and carry forward),
+## company and market_dates
+## the carry forward is recomputed only for gvkeys whose quarters changed or
+## that have a carried quarter starting between the old and new last CRSP date
+## the CRSP and Compustat deltas are always fetched, never served from the
+## query cache, and a full refresh bypasses the cache for every table
+def refresh_store(connect, path, needs, start, end, mode="incremental", refetch=REFETCH_QTRS, months=12, size=4):
+    if mode not in MODES:
+        raise ValueError("mode must be one of " + ", ".join(MODES))
+    marks = read_watermarks(path)
+    if mode == "full" or marks.get("needs") != needs or marks.get("start") != start:
+        shutil.rmtree(path, ignore_errors=True)
+        marks = {}
+    os.makedirs(path, exist_ok=True)
+
+    ## fetch windows past the marks
+    if marks:
+        crsp_start = (pd.Timestamp(marks["crsp"]) + pd.DateOffset(days=1)).strftime("%Y-%m-%d")
+        co_start, co_lookback = marks["co_ifndq"], refetch
+    else:
+        crsp_start, co_start, co_lookback = start, start, 3
+    lo, hi = co_ifndq_window(co_start, end, co_lookback)
+    print("fetching CRSP from", crsp_start, "and Compustat datadate from", lo.date())
+    raw = extract_merton(connect, needs, crsp_start, end, months=months, size=size,
+                         co_start=co_start, co_lookback=co_lookback,
+                         refresh=(mode == "full"), refresh_data=True, load_crsp=False)
+
+    ## CRSP days, one fetched partition at a time
+    for p in raw["crsp"]:
+        new = pd.read_parquet(p)
+        if len(new) > 0:
+            merge_crsp(path, new)
+    files = _crsp_files(path)
+    if not files:
+        raise ValueError("no CRSP days between " + str(start) + " and " + str(end))
+    last_date = pd.to_datetime(pd.read_parquet(files[-1], columns=['date']).date).max()
+
+    ## Compustat quarters
+    f = os.path.join(path, "co_ifndq.parquet")
+    stored = pd.read_parquet(f) if os.path.exists(f) else None
+    co_ifndq, changed = merge_co_ifndq(stored, raw["co_ifndq"], lo, hi)
+    _write(co_ifndq, f)
+
+    ## reporting windows and carry forward
+    f = os.path.join(path, "co_ifndq_filled.parquet")
+    if marks.get("last_date") is None or not os.path.exists(f):
+        filled = carry_forward(quarter_windows(co_ifndq), last_date)
+        print("carry forward for all", co_ifndq.gvkey.nunique(), "gvkeys")
+    else:
+        filled = pd.read_parquet(f)
+        crossed = carry_crossed(co_ifndq, marks["last_date"], last_date)
+        keys = set(changed) | set(crossed)
+        redo = co_ifndq.loc[co_ifndq.gvkey.isin(keys)]
+        filled = pd.concat([filled.loc[~filled.gvkey.isin(keys)],
+                            carry_forward(quarter_windows(redo), last_date)], ignore_index=True)
+        print("carry forward for", len(changed), "changed and", len(crossed), "crossed gvkeys")
+    filled = filled.sort_values(CO_KEYS + ['dt_start'], kind='stable').reset_index(drop=True)
+    _write(filled, f)
+
+    write_watermarks(path, {"crsp":last_date, "co_ifndq":co_ifndq.datadate.max(), "last_date":last_date,
+                            "start":start, "needs":needs, "refreshed_at":pd.Timestamp.now()})
+    return {"crsp_files":files, "co_ifndq":filled, "company":raw["company"], "market_dates":raw["market_dates"]}
@@ -0,0 +1,93 @@
+#------------------------------------------
+# Solver telemetry for merton_DD.py
+# per firm-month timing, function counts
+# and failure classes, worker throughput
+#------------------------------------------
+
+import numpy as np
+import pandas as pd
+from merton_model import window_index
+
+GROUP_KEYS = ['gvkey', 'fyr', 'permco', 'permno']
+
+## failure classes (zero debt rows are dropped by load_panel before any window)
+FAILURES = ["overflow", "non-convergence", "insufficient data"]
+
+TELEMETRY_COLS = GROUP_KEYS + ['date', 'gsubind', 'method', 'wall_time', 'nfev', 'iters',
+                               'solver', 'convergence', 'failure']
+
+## month end windows of a group that were never handed to a solver
+def skipped_by_group(sample):
+    sample = sample.sort_values('date')
+    windows = window_index(sample)
+    windows = windows.loc[windows.skip.notna()]
+
+    x = sample.iloc[windows.end.values - 1][GROUP_KEYS + ['date', 'gsubind']].reset_index(drop=True)
+    x['failure'] = windows.skip.values
+    return x
+
+## one telemetry row per firm-month from sim_batch or iter_by_group output,
+## plus the skipped windows from skipped_by_group
+## the failure rates count failure.notna(), so a solved row must carry no
+## failure and an unsolved one must carry one
+def telemetry_table(results, method, skipped=None):
+    bad = results['failure'].isna() != results['convergence'].astype(bool)
+    if bad.any():
+        raise ValueError("%d %s rows with failure not null exactly when not converged" % (bad.sum(), method))
+    tel = pd.DataFrame({c: results[c] for c in GROUP_KEYS + ['date', 'gsubind']})
+    tel['method'] = method
+    tel['wall_time'] = results['iteration_time']
+    tel['nfev'] = results['nfev'] if 'nfev' in results else np.nan
+    tel['iters'] = results['iters'] if 'iters' in results else np.nan
+    tel['solver'] = results['solver']
+    tel['convergence'] = results['convergence'].astype(bool)
+    tel['failure'] = results['failure']
+
+    if skipped is not None and len(skipped) > 0:
+        skip = skipped[GROUP_KEYS + ['date', 'gsubind', 'failure']].copy()
+        skip['method'] = method
+        skip['convergence'] = False
+        tel = pd.concat([tel, skip], ignore_index=True)
+
+    tel['date'] = pd.to_datetime(tel['date'])
+    return tel[TELEMETRY_COLS].sort_values(GROUP_KEYS + ['date'], kind='stable').reset_index(drop=True)
+
+## rows, seconds and rows per second by worker process from run_panel stats
+def worker_throughput(stats):
+    stats = pd.DataFrame(stats, columns=['pid', 'groups', 'rows', 'seconds'])
+    out = stats.groupby('pid').agg(chunks=('rows', 'size'), groups=('groups', 'sum'),
+                                   rows=('rows', 'sum'), seconds=('seconds', 'sum'))
+    out['rows_per_sec'] = out.rows/out.seconds
+    return out.reset_index()
+
+## parquet output kept apart from the pipe delimited DD results
+def write_telemetry(tel, path, workers=None):
+    tel.to_parquet(path, index=False)
+    if workers is not None:
+        workers.to_parquet(path.replace(".parquet", "_workers.parquet"), index=False)
+
+## latency histogram, slowest firms and failure rates by industry and year
+## latency and slowest firms only cover rows timed one at a time, so the
+## batched sim rows (no wall_time) are left out of both
+def telemetry_summary(tel, top=100, bins=None):
+    solved = tel.loc[tel.wall_time.notna() & (tel.wall_time > 0)]
+    if bins is None:
+        bins = np.logspace(-5, 2, 15)
+    counts, edges = np.histogram(solved.wall_time, bins=bins)
+    histogram = pd.DataFrame({"from":edges[:-1], "to":edges[1:], "count":counts})
+
+    slowest = (tel.loc[tel.wall_time.notna()].groupby(GROUP_KEYS + ['method'])
+                  .agg(wall_time=('wall_time', 'sum'), nfev=('nfev', 'sum'), months=('date', 'size'),
+                       failures=('failure', 'count'))
+                  .sort_values('wall_time', ascending=False)
+                  .head(top).reset_index())
+
+    tel = tel.assign(failed=tel.failure.notna(), year=tel.date.dt.year)
+    by_gsubind = tel.groupby(['method', 'gsubind'], dropna=False).failed.agg(['size', 'mean']).reset_index()
+    by_year = tel.groupby(['method', 'year']).failed.agg(['size', 'mean']).reset_index()
+    by_class = pd.crosstab([tel.method, tel.year], tel.failure.fillna("none"))
+
+    return {"latency_histogram":histogram, "slowest_firms":slowest,
+            "failure_by_gsubind":by_gsubind.rename(columns={"mean":"failure_rate"}),
+            "failure_by_year":by_year.rename(columns={"mean":"failure_rate"}),
+            "failure_by_class":by_class}
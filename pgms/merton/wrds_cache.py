@@ -0,0 +1,90 @@
+#------------------------------------------
+# Content addressed cache of WRDS query
+# results, one parquet file per query
+# keyed by a hash of the normalized SQL
+# and its parameters
+#
+# usage: python3 wrds_cache.py [table ...]
+# lists the cache, or drops every entry
+# whose query reads one of the tables
+#------------------------------------------
+
+import os, re, sys, json, time, glob, hashlib
+import pandas as pd
+
+## shared by every script, whatever its working directory
+CACHE_DIR = os.environ.get("WRDS_CACHE_DIR", os.path.expanduser("~/wrds_cache"))
+
+## seconds an entry stays fresh
+TTL = 24*3600
+
+## same SQL up to whitespace, case and a trailing semicolon gives the same key
+## string literals are kept as they are
+def normalize_sql(query):
+    parts = re.split(r"('(?:[^']|'')*')", query.strip().rstrip(";"))
+    out = []
+    for i, p in enumerate(parts):
+        out.append(p if i % 2 else re.sub(r"\s+", " ", p).lower())
+    return "".join(out).strip()
+
+def cache_key(query, params=None):
+    text = normalize_sql(query) + "\n" + json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def cache_path(query, params=None, cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, cache_key(query, params) + ".parquet")
+
+## entry exists and is younger than ttl seconds
+def is_fresh(path, ttl=TTL):
+    return os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl
+
+## sidecar with the query behind an entry, used to list and invalidate
+def write_meta(path, query, params=None, rows=None):
+    meta = {"query":normalize_sql(query), "params":params, "rows":rows,
+            "fetched_at":pd.Timestamp.now().isoformat(timespec='seconds')}
+    with open(path.replace(".parquet", ".json"), "w") as f:
+        json.dump(meta, f, default=str)
+
+## one row per entry: key, query, rows, fetched_at, size and age in seconds
+def cache_entries(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    out = []
+    for f in sorted(glob.glob(os.path.join(cache_dir, "*.json"))):
+        with open(f) as fh:
+            meta = json.load(fh)
+        data = f.replace(".json", ".parquet")
+        if os.path.exists(data):
+            out.append(dict(meta, key=os.path.basename(data)[:-8], mb=os.path.getsize(data)/2**20,
+                            age=time.time() - os.path.getmtime(data)))
+    return pd.DataFrame(out, columns=['key', 'query', 'params', 'rows', 'fetched_at', 'mb', 'age'])
+
+## drop one query's entry, every entry reading a table, or the whole cache
+## returns the number of entries removed
+def invalidate(query=None, params=None, table=None, cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    if query is not None:
+        keys = [cache_key(query, params)]
+    else:
+        entries = cache_entries(cache_dir)
+        if table is not None:
+            pattern = r"\b" + re.escape(table.lower()) + r"\b"
+            entries = entries.loc[entries['query'].str.contains(pattern)]
+        keys = entries.key.tolist()
+
+    n = 0
+    for k in keys:
+        for ext in (".parquet", ".json"):
+            f = os.path.join(cache_dir, k + ext)
+            if os.path.exists(f):
+                os.remove(f)
+                n += ext == ".parquet"
+    return n
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for table in sys.argv[1:]:
+            print(table, invalidate(table=table), "entries removed")
+    else:
+        print(cache_entries().to_string())
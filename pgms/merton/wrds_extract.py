@@ -0,0 +1,410 @@
+#------------------------------------------
+# Streaming fetch from WRDS Postgres into
+# Parquet row groups
+# rows come through a server side cursor
+# in batches, each batch becomes typed
+# Arrow arrays and one row group on disk
+#------------------------------------------
+
+import os, queue, threading, sqlite3, datetime
+from concurrent.futures import ThreadPoolExecutor
+from wrds_cache import TTL, cache_path, is_fresh, write_meta
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+## WRDS Postgres server
+WRDS = {"host":'wrds-pgdata.wharton.upenn.edu', "dbname":'wrds', "port":'9737'}
+
+## rows per round trip and per row group
+FETCH_SIZE = 100000
+
+## batches waiting to be written while the next one is fetched
+QUEUE_DEPTH = 2
+
+## Arrow type of each Postgres type oid, numerics come back as float64
+PG_TYPES = {16:pa.bool_(), 20:pa.int64(), 21:pa.int16(), 23:pa.int32(),
+            700:pa.float32(), 701:pa.float64(), 1700:pa.float64(),
+            25:pa.string(), 1042:pa.string(), 1043:pa.string(),
+            1082:pa.date32(), 1114:pa.timestamp('us'), 1184:pa.timestamp('us', tz='UTC')}
+
+#---------------------------
+# Cursor
+#---------------------------
+
+## DBAPI connection under a wrds.Connection or SQLAlchemy connection
+def _dbapi(conn):
+    while not hasattr(conn, 'cursor'):
+        conn = conn.connection
+    ## pooled SQLAlchemy proxy
+    return getattr(conn, 'dbapi_connection', conn)
+
+def _psycopg2(conn):
+    return type(conn).__module__.startswith('psycopg2')
+
+## named (server side) cursor on psycopg2, rows stay on the server until fetched
+## other drivers (sqlite3) already step through the result lazily
+def _cursor(conn, fetch_size):
+    if _psycopg2(conn):
+        cur = conn.cursor(name="fetch_%d_%d" % (os.getpid(), id(conn)))
+        cur.itersize = fetch_size
+        return cur
+    return conn.cursor()
+
+## a named cursor only lives inside a transaction, so an autocommit connection
+## (wrds.Connection builds its engine with AUTOCOMMIT) leaves autocommit for
+## the fetch; returns the setting to restore
+def _begin(conn):
+    autocommit = getattr(conn, 'autocommit', False)
+    if _psycopg2(conn) and autocommit:
+        conn.autocommit = False
+    return autocommit
+
+## end the read only transaction of the fetch and restore autocommit
+def _end(conn, autocommit):
+    if _psycopg2(conn):
+        conn.rollback()
+        if autocommit:
+            conn.autocommit = True
+
+#---------------------------
+# Arrow conversion
+#---------------------------
+
+## one fetched column as a typed Arrow array
+## typ None infers from the values, text dates (sqlite) are parsed
+def _column(values, typ):
+    if typ is None:
+        a = pa.array(values)
+        return a.cast(pa.float64()) if pa.types.is_null(a.type) else a
+    if pa.types.is_floating(typ):
+        return pa.array(np.array(values, dtype=float), from_pandas=True).cast(typ)
+    if pa.types.is_temporal(typ) and any(isinstance(v, str) for v in values):
+        return pa.array(pd.to_datetime(pd.Series(values)), from_pandas=True).cast(typ)
+    if pa.types.is_integer(typ) and any(isinstance(v, float) for v in values):
+        return pa.array(pd.array(values, dtype='Float64').astype('Int64')).cast(typ)
+    return pa.array(values, type=typ)
+
+## schema from an explicit {column: arrow type}, the cursor's type oids,
+## or failing both the first batch itself
+def _schema(description, rows, types=None):
+    types = types or {}
+    names = [d[0] for d in description]
+    cols = list(zip(*rows)) if rows else [() for _ in names]
+    fields = []
+    for name, d, values in zip(names, description, cols):
+        typ = types.get(name, PG_TYPES.get(d[1]))
+        if typ is None:
+            typ = _column(list(values), None).type
+        fields.append(pa.field(name, typ))
+    return pa.schema(fields)
+
+def _batch(rows, schema):
+    cols = list(zip(*rows))
+    return pa.record_batch([_column(list(v), f.type) for v, f in zip(cols, schema)], schema=schema)
+
+#---------------------------
+# Fetch
+#---------------------------
+
+## run query and stream the result into a parquet file at path
+## one row group per fetched batch, a writer thread writes batch k while
+## batch k+1 crosses the network, memory is about QUEUE_DEPTH + 2 batches
+## conn is a psycopg2, wrds or sqlite3 connection
+## types overrides the arrow type of named columns
+## returns the number of rows written
+def fetch_parquet(conn, query, path, fetch_size=FETCH_SIZE, types=None, params=None):
+    conn = _dbapi(conn)
+    autocommit = _begin(conn)
+    try:
+        return _fetch(conn, query, path, fetch_size, types, params)
+    finally:
+        _end(conn, autocommit)
+
+def _fetch(conn, query, path, fetch_size, types, params):
+    cur = _cursor(conn, fetch_size)
+    cur.execute(query, params) if params is not None else cur.execute(query)
+
+    rows = cur.fetchmany(fetch_size)
+    schema = _schema(cur.description, rows, types)
+
+    tmp = path + ".tmp"
+    pending = queue.Queue(maxsize=QUEUE_DEPTH)
+    errors = []
+
+    def write():
+        with pq.ParquetWriter(tmp, schema) as writer:
+            while True:
+                batch = pending.get()
+                if batch is None:
+                    break
+                if not errors:
+                    try:
+                        writer.write_batch(batch)
+                    except Exception as e:
+                        errors.append(e)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    n = 0
+    try:
+        while rows:
+            pending.put(_batch(rows, schema))
+            n += len(rows)
+            if errors:
+                break
+            rows = cur.fetchmany(fetch_size)
+    finally:
+        pending.put(None)
+        writer.join()
+        cur.close()
+
+    if errors:
+        os.remove(tmp)
+        raise errors[0]
+    os.replace(tmp, path)
+    return n
+
+## fetch_parquet then read the file back as a DataFrame
+def fetch_frame(conn, query, path, fetch_size=FETCH_SIZE, types=None, params=None, columns=None):
+    fetch_parquet(conn, query, path, fetch_size, types, params)
+    return pd.read_parquet(path, columns=columns)
+
+#---------------------------
+# Pushdown queries
+#---------------------------
+
+## SQL expression for every column a source can supply
+CRSP_SQL = {"date":"a.date", "permco":"a.permco", "permno":"a.permno", "cusip":"a.cusip",
+            "prc":"a.prc", "shrout":"a.shrout", "ret":"a.ret", "gvkey":"c.gvkey",
+            "mkt_cap":"abs(a.prc)*a.shrout/1E3 as mkt_cap",
+            "htick":"b.htick", "hcomnam":"b.hcomnam", "hshrcd":"b.hshrcd", "hnaics":"b.hnaics"}
+
+COMPANY_SQL = {"gvkey":"gvkey", "conm":"conm", "gsubind":"gsubind", "fic":"fic", "sic":"sic"}
+
+CO_IFNDQ_SQL = {"datadate":"datadate", "gvkey":"gvkey", "fyr":"fyr",
+                "current_liabilities":"lctq as current_liabilities",
+                "total_liabilities":"ltq as total_liabilities",
+                "lt_liabilities":""" CASE
+                      WHEN lctq IS NOT NULL AND ltq IS NOT NULL THEN ltq - lctq
+                      WHEN lctq IS NULL AND ltq IS NOT NULL THEN ltq
+                   END AS lt_liabilities""",
+                "face_value_debt":""" CASE
+                      WHEN lctq IS NOT NULL AND ltq IS NOT NULL THEN lctq + 0.5*ltq
+                      WHEN lctq IS NULL AND ltq IS NOT NULL THEN 0.5*ltq
+                      WHEN lctq IS NOT NULL AND ltq IS NULL THEN lctq
+                   END AS face_value_debt""",
+                "assets":"atq as assets"}
+
+SOURCES = {"crsp":CRSP_SQL, "company":COMPANY_SQL, "co_ifndq":CO_IFNDQ_SQL}
+
+## columns each source always returns, the join keys between them
+SOURCE_KEYS = {"crsp":["date", "gvkey", "permco", "permno"], "company":["gvkey"],
+               "co_ifndq":["datadate", "gvkey", "fyr"]}
+
+## common share codes
+SHRCD = (10, 11)
+
+## columns to fetch from each source for the downstream columns
+## a column goes to the first source that has it, join keys are always kept
+## columns no source supplies (tyd01y from H15, dt_start, dt_end) are left out
+def plan(columns):
+    out = {k: list(v) for k, v in SOURCE_KEYS.items()}
+    for c in columns:
+        for source, sql in SOURCES.items():
+            if c in sql:
+                if c not in out[source]:
+                    out[source].append(c)
+                break
+    return out
+
+## date literal, parsed first so only a date reaches the SQL
+def _date(x):
+    return "CAST('%s' AS DATE)" % pd.Timestamp(x).strftime("%Y-%m-%d")
+
+def _select(columns, sql):
+    return ",\n                   ".join(sql[c].strip() for c in columns)
+
+## daily CRSP prices with gvkey from CCM, only the columns asked for
+def crsp_query(columns, start, end, shrcd=SHRCD):
+    return """ SELECT %s
+            FROM crspq.dsf62 as a
+             LEFT JOIN crspq.dsfhdr62 as b
+                   ON  a.permco = b.permco
+                   AND a.permno = b.permno
+                   AND a.date between b.begdat and b.enddat
+             LEFT JOIN (SELECT gvkey, lpermno, linkdt, linkenddt
+                        FROM crspq.ccmxpf_linktable
+                        WHERE linktype IN ('LU', 'LC')
+                          AND linkprim in ('P', 'C')) as c
+                    ON  a.permno = c.lpermno
+                    AND a.date between c.linkdt AND coalesce(c.linkenddt, CAST('9999-12-31' AS DATE))
+             WHERE a.date between %s AND %s
+               AND b.hshrcd IN (%s)
+               AND a.prc IS NOT NULL """ % (_select(columns, CRSP_SQL), _date(start), _date(end),
+                                            ",".join(str(int(x)) for x in shrcd))
+
+def company_query(columns):
+    return """ SELECT %s
+            FROM comp.company """ % _select(columns, COMPANY_SQL)
+
+## Compustat quarters whose [dt_start, dt_end] window can meet a CRSP day in
+## [start, end]: datadate is dt_end and dt_start is at most 3 months earlier
+## lookback quarters before start are kept for the carry forward of late filers
+def co_ifndq_window(start, end, lookback=3):
+    return pd.Timestamp(start) - pd.DateOffset(months=3*lookback), pd.Timestamp(end) + pd.DateOffset(months=3)
+
+def co_ifndq_query(columns, start, end, lookback=3):
+    lo, hi = co_ifndq_window(start, end, lookback)
+    return """ SELECT %s
+            FROM comp.co_ifndq
+            WHERE indfmt = 'INDL' AND datafmt = 'STD' AND consol = 'C' AND popsrc = 'D'
+              AND datadate between %s AND %s """ % (_select(columns, CO_IFNDQ_SQL), _date(lo), _date(hi))
+
+## trading calendar
+DSI_QUERY = """ SELECT date
+            FROM crspq.dsi62
+        """
+
+#---------------------------
+# Concurrent extraction
+#---------------------------
+
+## plain psycopg2 connection to WRDS (credentials from ~/.pgpass)
+def wrds_connect():
+    import psycopg2
+    return psycopg2.connect(**WRDS)
+
+## small pool of connections, each query borrows one for its whole fetch
+def open_pool(connect=wrds_connect, size=4):
+    pool = queue.Queue()
+    for i in range(size):
+        pool.put(connect())
+    return pool
+
+def close_pool(pool):
+    while not pool.empty():
+        conn = pool.get()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+## consecutive [start, end] date ranges of about months each, as strings
+def date_partitions(start, end, months=12):
+    start = pd.Timestamp(start); end = pd.Timestamp(end)
+    out = []
+    while start <= end:
+        stop = min(start + pd.DateOffset(months=months) - pd.DateOffset(days=1), end)
+        out.append((start.strftime("%Y-%m-%d"), stop.strftime("%Y-%m-%d")))
+        start = stop + pd.DateOffset(days=1)
+    return out
+
+## run jobs [(name, query, path), ...] concurrently over the pool
+## jobs start in list order, so put the largest first
+## returns {name: rows written} in job order whatever order they finish in
+def fetch_many(pool, jobs, fetch_size=FETCH_SIZE, types=None):
+    def run(job):
+        name, query, path = job
+        conn = pool.get()
+        try:
+            return fetch_parquet(conn, query, path, fetch_size, types)
+        finally:
+            pool.put(conn)
+
+    with ThreadPoolExecutor(max_workers=max(pool.qsize(), 1)) as ex:
+        futures = [ex.submit(run, job) for job in jobs]
+        return {job[0]: f.result() for job, f in zip(jobs, futures)}
+
+## partition files read back and stacked in partition order
+def read_parts(paths, columns=None):
+    if not paths:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([pd.read_parquet(p, columns=columns) for p in paths], ignore_index=True)
+
+#---------------------------
+# Cached fetch
+#---------------------------
+
+## query result from the local cache, fetched only when missing or older than ttl
+## connect is a connection or a function returning one, called only on a miss
+def cached_frame(connect, query, ttl=TTL, params=None, cache_dir=None, refresh=False, fetch_size=FETCH_SIZE):
+    path = cache_path(query, params, cache_dir)
+    if refresh or not is_fresh(path, ttl):
+        opened = callable(connect) and not hasattr(connect, 'cursor')
+        conn = connect() if opened else connect
+        try:
+            rows = fetch_parquet(conn, query, path, fetch_size, params=params)
+        finally:
+            if opened:
+                conn.close()
+        write_meta(path, query, params, rows)
+    return pd.read_parquet(path)
+
+## every Merton source table in one concurrent pass: CRSP split into date
+## partitions, then co_ifndq, company and the dsi62 calendar
+## each result is a cache entry, only missing or stale ones are fetched and
+## the pool is opened only if something needs fetching
+## co_start and co_lookback set a different Compustat window (incremental runs)
+## refresh fetches every entry again, as in cached_frame; refresh_data only
+## the CRSP and co_ifndq queries (e.g. the delta past a store's marks), so
+## just the company and calendar reference tables come from the cache
+## returns a dict of DataFrames, with load_crsp False "crsp" is the list of
+## CRSP partition files instead, for builds that read them one at a time
+def extract_merton(connect, needs, start, end, months=12, size=4, ttl=TTL, cache_dir=None, fetch_size=FETCH_SIZE,
+                   co_start=None, co_lookback=3, refresh=False, refresh_data=False, load_crsp=True):
+    queries = [("crsp_%03d" % i, crsp_query(needs["crsp"], lo, hi))
+               for i, (lo, hi) in enumerate(date_partitions(start, end, months))]
+    queries += [("co_ifndq", co_ifndq_query(needs["co_ifndq"], co_start or start, end, co_lookback)),
+                ("company", company_query(needs["company"])),
+                ("market_dates", DSI_QUERY)]
+    jobs = [(name, q, cache_path(q, cache_dir=cache_dir)) for name, q in queries]
+
+    data = [name.startswith("crsp_") or name == "co_ifndq" for name, q, p in jobs]
+    misses = [job for job, d in zip(jobs, data) if refresh or (refresh_data and d) or not is_fresh(job[2], ttl)]
+    print("cache hits:", len(jobs) - len(misses), "of", len(jobs))
+    if misses:
+        pool = open_pool(connect, size=min(size, len(misses)))
+        try:
+            rows = fetch_many(pool, misses, fetch_size)
+        finally:
+            close_pool(pool)
+        for name, q, p in misses:
+            write_meta(p, q, rows=rows[name])
+        print("rows fetched:", rows)
+
+    parts = [p for name, q, p in jobs if name.startswith("crsp_")]
+    out = {"crsp":read_parts(parts) if load_crsp else parts}
+    for name, q, p in jobs:
+        if not name.startswith("crsp_"):
+            out[name] = pd.read_parquet(p)
+    return out
+
+#---------------------------
+# Local stand-in
+#---------------------------
+
+## sqlite database with a small CRSP shaped crspq.dsf62 so the fetch can be
+## run without WRDS, e.g. fetch_parquet(crsp_fixture(), "SELECT * FROM dsf62", path)
+def crsp_fixture(path=":memory:", n_firms=20, n_days=300, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2020-01-01", periods=n_days)
+    dsf = pd.DataFrame({"permno":np.repeat(10000 + np.arange(n_firms), n_days),
+                        "permco":np.repeat(20000 + np.arange(n_firms), n_days),
+                        "date":np.tile(dates.strftime("%Y-%m-%d"), n_firms),
+                        "prc":np.exp(rng.normal(3, 1, n_firms*n_days)),
+                        "shrout":np.repeat(rng.integers(1000, 100000, n_firms), n_days).astype(float),
+                        "cusip":np.repeat(["%06d10" % (100000 + i) for i in range(n_firms)], n_days)})
+    dsf.loc[rng.random(len(dsf)) < 0.01, "prc"] = np.nan
+    conn = sqlite3.connect(path, check_same_thread=False)
+    dsf.to_sql("dsf62", conn, index=False, if_exists="replace")
+    return conn
+
+if __name__ == "__main__":
+    conn = crsp_fixture()
+    t0 = datetime.datetime.now()
+    n = fetch_parquet(conn, "SELECT *, abs(prc)*shrout/1E3 as mkt_cap FROM dsf62 WHERE prc IS NOT NULL",
+                      "dsf62_fixture.parquet", fetch_size=1000, types={"date":pa.date32()})
+    print(n, "rows in", pq.ParquetFile("dsf62_fixture.parquet").num_row_groups, "row groups",
+          datetime.datetime.now() - t0)